@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# Times pcap_dissect.dissect_pkts() against dissect_parallel() with a few
+# job counts on a synthetic capture of Fuelband SE traffic (settings reads
+# and writes plus a graphics pack upload) and checks that the output and
+# the reconstructed graphics pack match.
+#
+# usage: benchmarks/bench_pcap_dissect.py [-n N_REQUESTS] [-j JOBS...] [--keep FILE]
+import argparse
+import contextlib
+import io
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import nike
+import pcap_dissect
+from bench_pcap_parse import format_pkt
+
+# a macOS USB header followed by a 64 byte HID report
+def darwin_pkt(request_type, endpoint, report):
+    header = bytearray(32)
+    header[0:2] = b'\x00\x01'
+    header[2] = 32
+    header[3] = request_type
+    header[30] = endpoint
+    return bytes(header) + report + bytes(64 - len(report))
+
+def request_report(tag, cmd):
+    return bytes([10, len(cmd) + 1, tag]) + bytes(cmd)
+
+# returns a list of reports for n_requests requests
+def make_requests(n_requests, seed=0):
+    rand = random.Random(seed)
+    settings = [nike.SE_SubCmdSett.WEIGHT, nike.SE_SubCmdSett.HEIGHT, nike.SE_SubCmdSett.GOAL_0]
+    reports = []
+    gpack_addr = 0
+    for i in range(n_requests):
+        tag = i & 0xff
+        kind = rand.random()
+        if kind < 0.2:
+            cmd = [nike.SE_Opcode.SETTING_GET.value, 1, rand.choice(settings).value]
+        elif kind < 0.4:
+            value = [rand.getrandbits(8) for _ in range(4)]
+            cmd = [nike.SE_Opcode.SETTING_SET.value, rand.choice(settings).value, len(value)] + value
+        else:
+            data = [rand.getrandbits(8) for _ in range(48)]
+            cmd = [nike.SE_Opcode.UPLOAD_GRAPHICS_PACK.value, nike.SE_MemCmds.WRITE_CHUNK.value,
+                gpack_addr & 0xff, (gpack_addr >> 8) & 0xff, len(data), 0] + data
+            gpack_addr = (gpack_addr + len(data)) % 0xf000
+        reports.append(request_report(tag, cmd))
+    return reports
+
+# writes every request as a SET_REPORT submit/complete pair followed by a
+# GET_REPORT submit/complete pair, like the Nike+ Connect app's traffic
+def write_capture(f, n_requests, seed=0):
+    for report in make_requests(n_requests, seed):
+        for pkt in [
+                darwin_pkt(0x00, 0x00, report),
+                darwin_pkt(0x01, 0x00, report),
+                darwin_pkt(0x00, 0x80, b''),
+                darwin_pkt(0x01, 0x80, bytes([10, 2, report[2], 0x00]))]:
+            f.write(format_pkt(pkt))
+            f.write('\n')
+
+# runs func with stdout captured; returns (output, gpack image, seconds)
+def run_captured(func, filename, **kwargs):
+    out = io.StringIO()
+    gpack = io.BytesIO()
+    with open(filename, 'rb') as f, contextlib.redirect_stdout(out):
+        t_start = time.perf_counter()
+        func(f, gpack_file=gpack, **kwargs)
+        elapsed = time.perf_counter() - t_start
+    return out.getvalue(), gpack.getvalue(), elapsed
+
+def dissect_sequential(f, **kwargs):
+    pcap_dissect.dissect_pkts(pcap_dissect.read_pkts(f), **kwargs)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmarks parallel dissection")
+    parser.add_argument('-n','--n-requests', default=50000, type=int, help="requests in the synthetic capture")
+    parser.add_argument('-j','--jobs', default=[2, 4], type=int, nargs='+', help="job counts to time")
+    parser.add_argument('--keep', default=None, help="write the capture here and keep it")
+    args = parser.parse_args()
+
+    if args.keep:
+        filename = args.keep
+    else:
+        fd, filename = tempfile.mkstemp(suffix='.txt')
+        os.close(fd)
+    try:
+        with open(filename, 'w') as f:
+            write_capture(f, args.n_requests)
+        print('capture: %.1f MB, %d requests' % (os.path.getsize(filename) / 1e6, args.n_requests))
+
+        ref_out, ref_gpack, ref_time = run_captured(dissect_sequential, filename)
+        print('sequential: %7.3fs' % ref_time)
+        same = True
+        for jobs in args.jobs:
+            out, gpack, elapsed = run_captured(pcap_dissect.dissect_parallel, filename, jobs=jobs)
+            match = out == ref_out and gpack == ref_gpack
+            same = same and match
+            print('%2d jobs:    %7.3fs (%.1fx) identical output: %s' % (jobs, elapsed, ref_time / elapsed, match))
+        if not same:
+            exit(1)
+    finally:
+        if not args.keep:
+            os.remove(filename)
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# Compares pcap_dissect.parse_pkts_from_file() against parse_pkts_fast() on a
+# synthetic Wireshark "packet bytes" text export and checks that both return
+# the same packets.
+#
+# usage: benchmarks/bench_pcap_parse.py [-n N_PKTS] [--keep FILE]
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import pcap_dissect
+
+def format_pkt(data):
+    lines = []
+    for offset in range(0, len(data), pcap_dissect.MAX_BYTES_PER_LINE):
+        row = data[offset:offset + pcap_dissect.MAX_BYTES_PER_LINE]
+        hex_str = ' '.join('%02x' % b for b in row)
+        ascii_str = ''.join(chr(b) if 0x20 <= b < 0x7f else '.' for b in row)
+        lines.append('%04x  %-*s   %s\n' % (offset, pcap_dissect.DATA_WIDTH, hex_str, ascii_str))
+    return ''.join(lines)
+
+# writes n_pkts USB packets that look like a Mac capture of a FuelbandSE:
+# a 32 byte USB header followed by a 64 byte HID report. every 10th packet
+# is a short one that the parsers should skip.
+def write_capture(f, n_pkts, seed=0):
+    rand = random.Random(seed)
+    for i in range(n_pkts):
+        header = bytearray(rand.getrandbits(8) for _ in range(32))
+        header[3] = rand.choice([0x00, 0x01])
+        header[30] = rand.choice([0x00, 0x80])
+        if i % 10 == 9:
+            data = header[:rand.randint(8, 34)]
+        else:
+            data = header + bytes(rand.getrandbits(8) for _ in range(64))
+        f.write(format_pkt(data))
+        f.write('\n')
+
+def timed(parse, filename):
+    with open(filename, 'rb') as f:
+        t_start = time.perf_counter()
+        pkts = parse(f)
+        return pkts, time.perf_counter() - t_start
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmarks the pcap text parsers")
+    parser.add_argument('-n','--n-pkts', default=200000, type=int, help="packets in the synthetic capture")
+    parser.add_argument('--keep', default=None, help="write the capture here and keep it")
+    args = parser.parse_args()
+
+    if args.keep:
+        filename = args.keep
+    else:
+        fd, filename = tempfile.mkstemp(suffix='.txt')
+        os.close(fd)
+    try:
+        with open(filename, 'w') as f:
+            write_capture(f, args.n_pkts)
+        size_mb = os.path.getsize(filename) / 1e6
+
+        slow_pkts, slow_time = timed(pcap_dissect.parse_pkts_from_file, filename)
+        fast_pkts, fast_time = timed(pcap_dissect.parse_pkts_fast, filename)
+
+        same = len(slow_pkts) == len(fast_pkts) and all(
+            a.id == b.id and a.data == b.data for a, b in zip(slow_pkts, fast_pkts))
+        print('capture: %.1f MB, %d packets' % (size_mb, len(slow_pkts)))
+        print('parse_pkts_from_file: %7.3fs (%6.1f MB/s)' % (slow_time, size_mb / slow_time))
+        print('parse_pkts_fast:      %7.3fs (%6.1f MB/s)' % (fast_time, size_mb / fast_time))
+        print('speedup: %.1fx; identical packets: %s' % (slow_time / fast_time, same))
+        if not same:
+            exit(1)
+    finally:
+        if not args.keep:
+            os.remove(filename)
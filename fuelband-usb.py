@@ -6,8 +6,47 @@
 import sys
 import time
 import nike
+import nike.dump
+import nike.firmware
+import nike.logreader
+import nike.manager
+import nike.sync
 import nike.utils as utils
 
+# run a command on every connected fuelband at once
+# usage: fuelband-usb.py all <status|set_time|desktopdata OUT_DIR|firmware FILE --experimental>
+if len(sys.argv) > 2 and sys.argv[1] == 'all':
+    manager = nike.manager.FuelbandManager()
+    manager.discover()
+    for path, ex in manager.open_errors:
+        print("failed to open %s: %s" % (path, ex))
+    if len(manager.fuelbands) == 0:
+        print("No fuelband devices found")
+        exit(-1)
+
+    if sys.argv[2] == 'status':
+        results = manager.run(nike.manager.job_status_snapshot)
+    elif sys.argv[2] == 'set_time':
+        results = manager.run(nike.manager.job_set_time)
+    elif sys.argv[2] == 'desktopdata' and len(sys.argv) > 3:
+        results = manager.run(nike.manager.job_dump_desktop_data, sys.argv[3])
+    elif sys.argv[2] == 'firmware' and len(sys.argv) > 3:
+        if '--experimental' not in sys.argv[4:]:
+            print('the firmware upload protocol is unverified and could brick the band; add --experimental to use it anyway')
+            exit(-1)
+        results = manager.run(nike.manager.job_upload_firmware, sys.argv[3], experimental=True)
+    else:
+        print("unknown command '%s'" % ' '.join(sys.argv[2:]))
+        exit(-1)
+
+    for result in results:
+        if result['error']:
+            print('%s: FAILED after %.3fs (%s)' % (result['path'], result['elapsed'], result['error']))
+        else:
+            print('%s: %.3fs %s' % (result['path'], result['elapsed'], result['result']))
+    manager.close()
+    exit(0)
+
 fb = nike.open_fuelband()
 if fb == None:
     print("No fuelband devices found")
@@ -17,21 +56,34 @@ print('opened %s' % (fb.getModelNumber()))
 
 if len(sys.argv) > 1:
     if sys.argv[1] == 'log':
-        fb.dumpLog()
-        print(fb.log)
+        # usage: log [-f]
+        # -f keeps polling for new log output until ctrl+c
+        reader = nike.logreader.LogReader(fb)
+        try:
+            for line in reader.readLines(follow='-f' in sys.argv[2:]):
+                print(line, flush=True)
+        except KeyboardInterrupt:
+            pass
 
     elif sys.argv[1] == 'status':
         fb.printStatus()
 
-    elif sys.argv[1] == 'desktopdata':
+    elif sys.argv[1] in ['desktopdata', 'workout']:
+        # usage: <desktopdata|workout> get FILE
+        if not isinstance(fb, nike.Fuelband):
+            print('%s is only supported on the gen 1 Fuelband' % sys.argv[1])
+            exit(-1)
         if sys.argv[2] == 'get':
             if len(sys.argv) > 3:
-                dump = fb.dumpMemory([0x50, 0x37, 0x36], 280)
+                if sys.argv[1] == 'desktopdata':
+                    command, max_bytes = [0x50, 0x37, 0x36], 280
+                else:
+                    command, max_bytes = [0x19], 0xFFFFFF
+                def print_progress(status, offset, n_bytes):
+                    print('\r%d byte(s) dumped (offset 0x%06x)' % (n_bytes, offset), end='')
                 with open(sys.argv[3], "wb") as f:
-                    #for t_byte in dump:
-                    f.write(bytes(dump))
-            #utils.print_hex(dump)
-            #utils.print_ascii(dump)
+                    n_bytes = fb.dumpMemoryTo(command, f, max_bytes, print_progress)
+                print("\ndumped %d byte(s) to '%s'" % (n_bytes, sys.argv[3]))
     elif sys.argv[1] == 'set_time':
         fb.setTimeAndDate()
     elif sys.argv[1] == 'factory_reset':
@@ -39,11 +91,71 @@ if len(sys.argv) > 1:
     elif sys.argv[1] == 'latchup':
         fb.doLatchup()
     elif sys.argv[1] == 'dump_graphics_pack':
+        if not isinstance(fb, nike.FuelbandSE):
+            print('dump_graphics_pack is only supported on the Fuelband SE')
+            exit(-1)
         filename = 'graphics_pack.bin'
-        data = fb.readGraphicsPackData(0x0000, 4096)
+        n_bytes = 0
         with open(filename,'wb') as f:
-            f.write(bytes(data))
-        print("dumped %d byte(s) to '%s'" % (len(data),filename))
+            for addr, chunk in fb.iterMemory(nike.SE_Opcode.UPLOAD_GRAPHICS_PACK, 0x0000, 4096):
+                f.write(chunk)
+                n_bytes += len(chunk)
+        print("dumped %d byte(s) to '%s'" % (n_bytes,filename))
+    elif sys.argv[1] == 'dump':
+        # usage: dump <desktop|graphics|ext> FILE [SIZE]
+        # resumable; rerun the same command to continue an interrupted dump
+        if not isinstance(fb, nike.FuelbandSE):
+            print('dump is only supported on the Fuelband SE')
+            exit(-1)
+        regions = {
+            'desktop' : nike.SE_Opcode.DESKTOP_DATA,
+            'graphics' : nike.SE_Opcode.UPLOAD_GRAPHICS_PACK,
+            'ext' : nike.SE_Opcode.MEMORY_EXT
+        }
+        size = int(sys.argv[4], 0) if len(sys.argv) > 4 else 0x10000
+        def print_progress(done, total):
+            print('\r%d / %d bytes' % (done, total), end='')
+        n_bytes = nike.dump.dump_memory(
+            fb,
+            regions[sys.argv[2]],
+            0x0000,
+            size,
+            sys.argv[3],
+            reconnect=nike.wait_for_fuelband,
+            progress=print_progress)
+        print("\ndumped %d byte(s) to '%s'" % (n_bytes, sys.argv[3]))
+    elif sys.argv[1] == 'sync':
+        # usage: sync STATE_DIR
+        # incremental desktop data sync against the image from the last sync
+        result = nike.sync.DesktopDataSync(sys.argv[2]).sync(fb)
+        print('synced %d byte(s) for %s; transferred %d byte(s)%s' % (
+            len(result['image']),
+            result['serial'],
+            result['bytes_read'],
+            ' (full)' if result['full'] else ''))
+    elif sys.argv[1] == 'upload_graphics_pack':
+        # usage: upload_graphics_pack FILE
+        with open(sys.argv[2],'rb') as f:
+            data = f.read()
+        stats = fb.writeGraphicsPackData(0x0000, data)
+        print("uploaded %d byte(s) in %.3fs (%.0f bytes/sec, verify took %.3fs)" % (
+            stats['bytes'], stats['elapsed'], stats['bytes_per_sec'], stats['verify_elapsed']))
+    elif sys.argv[1] == 'upload_firmware':
+        # usage: upload_firmware FILE --experimental
+        if '--experimental' not in sys.argv[3:]:
+            print('the firmware upload protocol is unverified and could brick the band; add --experimental to use it anyway')
+            exit(-1)
+        def print_progress(done, total, rate, eta):
+            eta_str = '--' if eta is None else '%ds' % eta
+            print('\r%d / %d bytes (%.1f KiB/s, ETA %s)' % (done, total, rate / 1024, eta_str), end='')
+        stats = nike.firmware.upload_firmware(
+            fb,
+            sys.argv[2],
+            experimental=True,
+            reconnect=nike.wait_for_fuelband,
+            progress=print_progress)
+        print("\nuploaded %d byte(s) in %.1fs (%d reconnect(s))" % (
+            stats['bytes'], stats['elapsed'], stats['reconnects']))
     elif sys.argv[1] == 'scan_cmds':
         for cmd in range(0x00, 0x100):
             if cmd == 0x02:
@@ -1,14 +1,23 @@
-
 # requires hidapi:
 # https://github.com/trezor/cython-hidapi
 import hid
 import nike.utils as utils
+from nike.metrics import TransportMetrics
+import collections
+import contextlib
 import datetime
+import time
 from enum import Enum
 
 GOAL_TYPE_CURRENT  = 0x00
 GOAL_TYPE_TOMORROW = 0x01
 
+# size of a HID feature report in bytes
+REPORT_SIZE = 64
+
+# tags 0x00 to 0xFE roll over for pipelined transactions
+TAG_RESERVED = 0xFF
+
 # hand orientation
 class Orientation(Enum):
     LEFT = 1
@@ -21,9 +30,20 @@ class Gender(Enum):
 
 class FuelbandBase():
     VID = 0x11ac# Nike USB vendor id
+    OPCODE_ENUM = None# Enum naming the opcodes in metrics
 
     def __init__(self, device):
         self.device = device
+        # max number of outstanding requests used by sendPipelined()
+        self.window = 1
+        self.next_tag = 0
+        # preallocated report buffers used by every transaction
+        self.tx_buf = bytearray(REPORT_SIZE)
+        self.tx_view = memoryview(self.tx_buf)
+        self.rx_buf = bytearray(REPORT_SIZE)
+        self.rx_view = memoryview(self.rx_buf)
+        # TransportMetrics, or None when instrumentation is disabled
+        self.metrics = None
 
         self.log = ''
 
@@ -33,14 +53,12 @@ class FuelbandBase():
         self.serial_number = ''
         self.hardware_revision = ''
 
+    # trim - cut the response to the length the band reports in its length
+    #     byte. the report is padded to its full size otherwise
     def send(self, cmd, **kwargs):
         verbose = kwargs.get('verbose',False)
         report_id = kwargs.get('report_id',0x01)
-
-        # convert all enums in cmd to their integer values
-        for i in range(len(cmd)):
-            if isinstance(cmd[i], Enum):
-                cmd[i] = cmd[i].value
+        trim = kwargs.get('trim',False)
 
         # seems to be something that can get 'wrapped' backed in the
         # response packets... kinda of like a sequence id? initially i
@@ -49,21 +67,203 @@ class FuelbandBase():
         # becomes nonsense.
         tag = kwargs.get('tag',0xFF)
 
-        cmd_prefix = [report_id, len(cmd) + 1, tag]
-        cmd = cmd_prefix + cmd
+        return list(self.transact(cmd, report_id=report_id, tag=tag, verbose=verbose, trim=trim))
 
-        if verbose: print("cmd: %s" % (utils.to_hex(cmd)))
-        res = self.device.send_feature_report(cmd)
-
-        buf = self.device.get_feature_report(0x01, 64)
-        if verbose: print("rsp (hex):   %s" % (utils.to_hex(buf)))
-        if verbose: print("rsp (ascii): %s" % (utils.to_ascii(buf)))
-
-        if len(buf) > 3:
-            buf = buf[3:]
+    # Same as send(), but without any per call allocations. The command is
+    # encoded into a reusable report buffer and the response is returned as
+    # a memoryview into the receive buffer. The view is only valid until the
+    # next transaction; copy it if it needs to stick around.
+    def transact(self, cmd, **kwargs):
+        verbose = kwargs.get('verbose',False)
+        report_id = kwargs.get('report_id',0x01)
+        tag = kwargs.get('tag',0xFF)
+        trim = kwargs.get('trim',False)
+
+        self.__sendReport(cmd, report_id, tag, verbose)
+        n_rsp = self.__recvReport(verbose)
+        if trim and n_rsp > 1:
+            # the length byte counts the tag and the response data
+            n_rsp = min(n_rsp, self.rx_buf[1] + 2)
+        if n_rsp > 3:
+            return self.rx_view[3:n_rsp]
+        return self.rx_view[0:0]
+
+    # Turns on transport metrics (see nike.metrics) and returns them
+    # metrics - optional TransportMetrics to share between devices
+    def enableMetrics(self, metrics=None):
+        if metrics is None:
+            metrics = TransportMetrics(self.OPCODE_ENUM)
+        self.metrics = metrics
+        return metrics
+
+    def disableMetrics(self):
+        self.metrics = None
+
+    # counts a failed request against an opcode when metrics are enabled
+    def recordError(self, opcode, err=None):
+        if self.metrics is not None:
+            if isinstance(opcode, Enum):
+                opcode = opcode.value
+            self.metrics.recordError(opcode, err)
+
+    # returns the next rolling tag to use for a pipelined request. 0xFF is
+    # left for send() so it never collides with a pipelined transaction.
+    def nextTag(self):
+        tag = self.next_tag
+        self.next_tag = (tag + 1) % TAG_RESERVED
+        return tag
+
+    # Sends a sequence of commands, keeping up to 'window' requests in flight
+    # at once. Every request gets its own rolling tag and responses are
+    # matched back to their request by the tag the device echoes. Responses
+    # carrying a tag we aren't waiting on are stale and get discarded, and
+    # requests whose response got lost are resent up to 'retries' times
+    # (with the window halved each time a loss is detected).
+    # Yields the responses in request order as memoryviews (see transact())
+    # Raises PipelineError once a request ran out of retries. the band is
+    # still connected then, unlike the OSError raised when the transport
+    # fails.
+    # cmds - list of commands (only send idempotent requests like reads)
+    # window - max outstanding requests (defaults to self.window). anything
+    #     above 1 only helps if the device queues up its responses. a real
+    #     band doesn't: a HID feature report holds a single current report,
+    #     so self.window stays 1 on hardware. only nike.emulator queues
+    #     responses (see its queue_depth), so speedups from a bigger window
+    #     measured against it are not hardware gains.
+    def sendPipelined(self, cmds, **kwargs):
+        verbose = kwargs.get('verbose',False)
+        report_id = kwargs.get('report_id',0x01)
+        window = max(1, kwargs.get('window',self.window))
+        retries = kwargs.get('retries',2)
+
+        n_cmds = len(cmds)
+        attempts = [0] * n_cmds
+        results = {}# idx -> response that came back ahead of its turn
+        pending = collections.OrderedDict()# tag -> idx (in send order)
+        resend = collections.deque()
+        next_idx = 0
+        next_yield = 0
+        n_stale = 0
+
+        def requeue(lost):
+            nonlocal window
+            if len(lost) > 0:
+                # the device dropped responses; back off to fewer in flight
+                window = max(1, window // 2)
+            for tag, idx in lost:
+                del pending[tag]
+                if self.metrics is not None:
+                    opcode = cmds[idx][0] if len(cmds[idx]) > 0 else None
+                    self.metrics.recordRetry(opcode.value if isinstance(opcode, Enum) else opcode)
+                attempts[idx] += 1
+                if attempts[idx] > retries:
+                    raise PipelineError(idx, attempts[idx])
+                resend.append(idx)
+
+        try:
+            while next_yield < n_cmds:
+                while len(pending) < window and (resend or next_idx < n_cmds):
+                    if resend:
+                        idx = resend.popleft()
+                    else:
+                        idx = next_idx
+                        next_idx += 1
+                    tag = self.nextTag()
+                    self.__sendReport(cmds[idx], report_id, tag, verbose)
+                    pending[tag] = idx
+
+                n_rsp = self.__recvReport(verbose)
+                if n_rsp < 3:
+                    # nothing came back. assume everything in flight was lost
+                    requeue(list(pending.items()))
+                    continue
+                tag = self.rx_buf[2]
+                if tag not in pending:
+                    # stale response from an older transaction
+                    n_stale += 1
+                    if n_stale > window:
+                        requeue(list(pending.items()))
+                        n_stale = 0
+                    continue
+                n_stale = 0
+
+                # responses come back in order, so anything sent before this
+                # request that is still outstanding was dropped by the device
+                lost = []
+                for p_tag, p_idx in pending.items():
+                    if p_tag == tag:
+                        break
+                    lost.append((p_tag, p_idx))
+                requeue(lost)
+
+                idx = pending.pop(tag)
+                if idx == next_yield:
+                    # common case. hand out the receive buffer as is
+                    yield self.rx_view[3:n_rsp]
+                    next_yield += 1
+                else:
+                    results[idx] = bytes(self.rx_view[3:n_rsp])
+                while next_yield in results:
+                    yield results.pop(next_yield)
+                    next_yield += 1
+        except GeneratorExit:
+            # consumer stopped early. flush the responses still in flight so
+            # they don't get mistaken for replies to the next transaction.
+            for i in range(len(pending)):
+                self.device.get_feature_report(0x01, 64)
+            raise
+
+    def __sendReport(self, cmd, report_id, tag, verbose):
+        # encode the report in place: report id, length, tag, command
+        n_cmd = len(cmd)
+        if n_cmd + 3 > REPORT_SIZE:
+            raise ValueError('command too long (%d bytes)' % n_cmd)
+        tx_buf = self.tx_buf
+        tx_buf[0] = report_id
+        tx_buf[1] = n_cmd + 1
+        tx_buf[2] = tag
+        for i in range(n_cmd):
+            c = cmd[i]
+            # Enum members are converted to their integer values
+            tx_buf[i + 3] = c.value if isinstance(c, Enum) else c
+
+        report = self.tx_view[0:n_cmd + 3]
+        if verbose: print("cmd: %s" % (utils.to_hex(report)))
+        metrics = self.metrics
+        if metrics is None:
+            return self.device.send_feature_report(report)
+
+        metrics.preSend(report)
+        t_start = time.perf_counter()
+        try:
+            res = self.device.send_feature_report(report)
+        except OSError as ex:
+            metrics.recordError(report[3] if n_cmd > 0 else None, ex)
+            raise
+        metrics.recordSend(report, t_start, time.perf_counter())
+        return res
+
+    # reads a response report into the receive buffer
+    # returns the number of bytes received
+    def __recvReport(self, verbose):
+        metrics = self.metrics
+        if metrics is None:
+            buf = self.device.get_feature_report(0x01, REPORT_SIZE)
         else:
-            buf = []
-        return buf
+            t_start = time.perf_counter()
+            try:
+                buf = self.device.get_feature_report(0x01, REPORT_SIZE)
+            except OSError as ex:
+                metrics.recordError(None, ex)
+                raise
+            t_end = time.perf_counter()
+        n_rsp = min(len(buf), REPORT_SIZE)
+        self.rx_buf[0:n_rsp] = buf[0:n_rsp]
+        if metrics is not None:
+            metrics.recordRecv(self.rx_view[0:n_rsp], t_start, t_end)
+        if verbose: print("rsp (hex):   %s" % (utils.to_hex(self.rx_view[0:n_rsp])))
+        if verbose: print("rsp (ascii): %s" % (utils.to_ascii(self.rx_view[0:n_rsp])))
+        return n_rsp
 
 FB_COMMAND_LUT = {
     'latchup' : {
@@ -233,26 +433,59 @@ class Fuelband(FuelbandBase):
         self.timestamp_lastgoalreset_raw = buf[0:4]
         self.timestamp_lastgoalreset = utils.intFromBigEndian(buf[0:4])
 
-    def dumpLog(self):
-
-        buf = [0]
-        while len(buf) > 0:
-            buf = self.send([0xf6], verbose=False)
-            for t_char in buf:
-                self.log = self.log + '%c' % t_char
+    # returns the next piece of the system log (empty once it ran dry)
+    def readLogChunk(self):
+        return bytes(self.transact([0xf6]))
 
-    def dumpMemory(self, command, max_bytes=0xFFFFFF):
-        dump = []
+    def dumpLog(self):
+        pieces = [self.log]
+        chunk = self.readLogChunk()
+        while len(chunk) > 0:
+            pieces.append(chunk.decode('latin-1'))
+            chunk = self.readLogChunk()
+        self.log = ''.join(pieces)
+
+    # Streams a memory dump chunk by chunk
+    # command - dump command (ie. [0x50, 0x37, 0x36] for desktop data or
+    #     [0x19] for workouts). the 3 byte offset gets appended to it.
+    # max_bytes - stop once at least this many bytes were dumped
+    # progress - optional function called as progress(status, offset, n_bytes)
+    #     after every chunk
+    # yields the data of each chunk as a memoryview that is only valid until
+    # the next chunk is requested
+    def iterDump(self, command, max_bytes=0xFFFFFF, progress=None):
+        cmd = list(command) + [0x00, 0x00, 0x00]
+        n_cmd = len(cmd)
+        n_bytes = 0
         status = 0x01
-        offset = [0x00, 0x00, 0x00]
         while status == 0x01:
-            buf = self.send(command + offset)
-            #utils.print_hex(buf)
+            buf = self.transact(cmd)
+            if len(buf) < 4:
+                break
             status = buf[0]
-            offset = buf[1:4]
-            dump = dump + buf[4:]
-            if len(dump) >= max_bytes: status = 0xFF
-            utils.print_hex([status] + offset)
+            # the band tells us where to continue
+            cmd[n_cmd - 3] = buf[1]
+            cmd[n_cmd - 2] = buf[2]
+            cmd[n_cmd - 1] = buf[3]
+            n_bytes += len(buf) - 4
+            if n_bytes >= max_bytes: status = 0xFF
+            if progress: progress(status, utils.intFromBigEndian(buf[1:4]), n_bytes)
+            yield buf[4:]
+
+    # Streams a memory dump into a writer (ie. a file opened with 'wb')
+    # returns the number of bytes written
+    def dumpMemoryTo(self, command, writer, max_bytes=0xFFFFFF, progress=None):
+        n_bytes = 0
+        for chunk in self.iterDump(command, max_bytes, progress):
+            writer.write(chunk)
+            n_bytes += len(chunk)
+        return n_bytes
+
+    # returns the whole memory dump as a bytearray (see iterDump())
+    def dumpMemory(self, command, max_bytes=0xFFFFFF, progress=None):
+        dump = bytearray()
+        for chunk in self.iterDump(command, max_bytes, progress):
+            dump += chunk
         return dump
 
     def printStatusBitfield(self, show_expected=False):
@@ -442,8 +675,142 @@ class MemoryError(RuntimeError):
             return "I/O failed"
         return "Unknown error"
 
+# The band stopped answering a pipelined request (see sendPipelined()). This
+# is a protocol failure, not a disconnect, so it isn't an OSError: callers that
+# reconnect after an OSError must not treat it as a reboot.
+class PipelineError(RuntimeError):
+    def __init__(self, idx, attempts):
+        self.idx = idx
+        self.attempts = attempts
+
+    def __str__(self):
+        return "no response for pipelined request #%d after %d attempt(s)" % (self.idx, self.attempts)
+
+# caching policies for SettingsCache
+class SettingPolicy(Enum):
+    STATIC = 0# only changes when we write it (or on factory reset)
+    VOLATILE = 1# changes on its own, never cached
+
+# settings without an entry here are cached for SettingsCache.default_ttl
+# seconds. a number instead of a SettingPolicy is a ttl in seconds.
+DEFAULT_SETTING_POLICIES = {
+    SE_SubCmdSett.SERIAL_NUMBER : SettingPolicy.STATIC,
+    SE_SubCmdSett.BAND_COLOR : SettingPolicy.STATIC,
+    SE_SubCmdSett.BLE_ADDRESS : SettingPolicy.STATIC,
+    SE_SubCmdSett.DATE_OF_BIRTH : SettingPolicy.STATIC,
+    SE_SubCmdSett.GENDER : SettingPolicy.STATIC,
+    SE_SubCmdSett.HEIGHT : SettingPolicy.STATIC,
+    SE_SubCmdSett.FIRST_NAME : SettingPolicy.STATIC,
+    SE_SubCmdSett.HANDEDNESS : SettingPolicy.STATIC,
+    SE_SubCmdSett.FUEL : SettingPolicy.VOLATILE,
+    SE_SubCmdSett.CALORIES : SettingPolicy.VOLATILE,
+    SE_SubCmdSett.STEPS : SettingPolicy.VOLATILE,
+    SE_SubCmdSett.DISTANCE : SettingPolicy.VOLATILE,
+    SE_SubCmdSett.ACTIVE_TIME : SettingPolicy.VOLATILE,
+    SE_SubCmdSett.LIFETIME_FUEL : SettingPolicy.VOLATILE,
+    SE_SubCmdSett.HOURS_WON : SettingPolicy.VOLATILE,
+    SE_SubCmdSett.TEMP_GOAL : SettingPolicy.VOLATILE
+}
+
+# Write-through cache of setting values keyed by SE_SubCmdSett code
+# policies - dict of SE_SubCmdSett -> SettingPolicy or ttl in seconds. merged
+#     on top of DEFAULT_SETTING_POLICIES.
+# default_ttl - ttl in seconds for settings without a policy
+class SettingsCache(object):
+    def __init__(self, policies=None, default_ttl=60.0, clock=time.monotonic):
+        self.policies = {}
+        for code, policy in DEFAULT_SETTING_POLICIES.items():
+            self.policies[code.value] = policy
+        for code, policy in (policies or {}).items():
+            self.policies[code.value if isinstance(code, Enum) else code] = policy
+        self.default_ttl = default_ttl
+        self.clock = clock
+        self.entries = {}# code -> (expire time or None, value)
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.per_setting = {}# code -> [hits, misses]
+
+    def policy(self, code):
+        return self.policies.get(code, self.default_ttl)
+
+    # returns the cached value (as a list) or None on a miss
+    def lookup(self, code):
+        policy = self.policy(code)
+        if policy == SettingPolicy.VOLATILE:
+            self.bypassed += 1
+            return None
+        counts = self.per_setting.setdefault(code, [0, 0])
+        entry = self.entries.get(code)
+        if entry is not None and (entry[0] is None or self.clock() < entry[0]):
+            self.hits += 1
+            counts[0] += 1
+            return list(entry[1])
+        self.misses += 1
+        counts[1] += 1
+        return None
+
+    def store(self, code, value):
+        policy = self.policy(code)
+        if policy == SettingPolicy.VOLATILE:
+            return
+        expire = None
+        if policy != SettingPolicy.STATIC:
+            expire = self.clock() + policy
+        self.entries[code] = (expire, bytes(value))
+
+    # drops one setting, or everything when code is None
+    def invalidate(self, code=None):
+        if code is None:
+            self.entries.clear()
+        else:
+            self.entries.pop(code, None)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        per_setting = {}
+        for code, counts in self.per_setting.items():
+            try:
+                name = SE_SubCmdSett(code).name
+            except ValueError:
+                name = '%d' % code
+            per_setting[name] = {'hits' : counts[0], 'misses' : counts[1]}
+        return {
+            'hits' : self.hits,
+            'misses' : self.misses,
+            'bypassed' : self.bypassed,
+            'hit_rate' : float(self.hits) / lookups if lookups else 0.0,
+            'entries' : len(self.entries),
+            'settings' : per_setting
+        }
+
+# largest READ_CHUNK that fits in a report: report id, length, tag, status
+# and byte count take up the first 5 bytes of the response
+MAX_READ_CHUNK = REPORT_SIZE - 5
+# largest WRITE_CHUNK payload: report id, length, tag, opcode, subcmd, 16bit
+# address and 16bit length come before the data
+MAX_WRITE_CHUNK = REPORT_SIZE - 9
+# chunk size that all known firmware accepts
+KNOWN_GOOD_READ_CHUNK = 58
+MIN_READ_CHUNK = 8
+# MemoryError codes that mean 'try a smaller chunk'
+READ_CHUNK_BACKOFF_ERRORS = [1, 2]
+
+# next READ_CHUNK size to try given the largest size seen working (lo) and
+# the smallest size seen failing (hi). bisects, but tries the known good size
+# first.
+def _nextReadChunkSize(lo, hi):
+    if lo < KNOWN_GOOD_READ_CHUNK < hi:
+        return KNOWN_GOOD_READ_CHUNK
+    return max(MIN_READ_CHUNK, (max(lo, MIN_READ_CHUNK) + hi) // 2)
+
 class FuelbandSE(FuelbandBase):
     PID = 0x317d# Fuelband SE USB product id
+    OPCODE_ENUM = SE_Opcode
+    # (firmware key, opcode) -> (read chunk size, lo, hi). shared by all
+    # instances so a size discovered once is reused for every band running
+    # the same firmware.
+    READ_CHUNK_SIZES = {}
 
     def __init__(self, device):
         super().__init__(device)
@@ -451,12 +818,39 @@ class FuelbandSE(FuelbandBase):
         self.goal_current = None# 16bit fuel goal
         self.goal_tomorrow = None# 16bit fuel goal
 
+        # SettingsCache, or None when settings caching is disabled
+        self.settings_cache = None
+        self.firmware_key = None
+
+    # Turns on the write-through settings cache and returns it. All kwargs
+    # are passed to SettingsCache (policies, default_ttl, ...).
+    def enableSettingsCache(self, **kwargs):
+        self.settings_cache = SettingsCache(**kwargs)
+        return self.settings_cache
+
+    def disableSettingsCache(self):
+        self.settings_cache = None
+
     def setSetting(self, setting_code, opt_buf, **kwargs):
         verbose = kwargs.get('verbose',False)
         buf = self.send([SE_Opcode.SETTING_SET, setting_code, len(opt_buf)] + opt_buf, verbose=verbose)
-        return len(buf) == 1 and buf[0] == 0x00
+        okay = len(buf) == 1 and buf[0] == 0x00
+        if self.settings_cache is not None:
+            code = setting_code.value if isinstance(setting_code, Enum) else setting_code
+            if okay:
+                self.settings_cache.store(code, opt_buf)
+            else:
+                self.settings_cache.invalidate(code)
+        return okay
 
     def getSetting(self, setting_code):
+        cache = self.settings_cache
+        if cache is not None:
+            code = setting_code.value if isinstance(setting_code, Enum) else setting_code
+            value = cache.lookup(code)
+            if value is not None:
+                return value
+
         setting_len = 1 # setting_code always 1 byte?
         buf = self.send([SE_Opcode.SETTING_GET, setting_len, setting_code], verbose=False)
         # FuelbandBase.send() only returns the last part of the full response buffer
@@ -476,10 +870,32 @@ class FuelbandSE(FuelbandBase):
         # +---------------------- USB HID report id (always 1?)
 
         # TODO could check status and wrapped command for validity
-        return buf[4:]
+        value = buf[4:]
+        if cache is not None:
+            cache.store(code, value)
+        return value
+
+    # reads several settings at once using pipelined transactions
+    # returns a list with the value of each setting (same as getSetting)
+    def getSettings(self, setting_codes, **kwargs):
+        codes = [code.value if isinstance(code, Enum) else code for code in setting_codes]
+        values = [None] * len(codes)
+        cache = self.settings_cache
+        if cache is not None:
+            values = [cache.lookup(code) for code in codes]
+
+        misses = [idx for idx, value in enumerate(values) if value is None]
+        cmds = [[SE_Opcode.SETTING_GET.value, 1, codes[idx]] for idx in misses]
+        for idx, buf in zip(misses, self.sendPipelined(cmds, **kwargs)):
+            values[idx] = list(buf[4:])
+            if cache is not None:
+                cache.store(codes[idx], values[idx])
+        return values
 
     def doFactoryReset(self):
         self.send([SE_Opcode.RESET_STATUS])
+        if self.settings_cache is not None:
+            self.settings_cache.invalidate()
 
     def getModelNumber(self):
         buf = self.send([SE_Opcode.VERSION])
@@ -491,6 +907,14 @@ class FuelbandSE(FuelbandBase):
         # based on ghidra disass, i think this might be the firmware version.
         return utils.to_ascii(buf[15:])
 
+    # returns the version block at the start of the VERSION response (hex).
+    # used to remember per firmware quirks like the max read chunk size.
+    def getFirmwareKey(self):
+        if self.firmware_key is None:
+            buf = self.send([SE_Opcode.VERSION])
+            self.firmware_key = utils.to_hex(buf[:15])
+        return self.firmware_key
+
     def getSerialNumber(self):
         buf = self.getSetting(SE_SubCmdSett.SERIAL_NUMBER)
         return utils.to_ascii(buf)
@@ -577,6 +1001,11 @@ class FuelbandSE(FuelbandBase):
         setting_code = SE_SubCmdSett.GOAL_0.value + goal_idx
         return utils.intFromLittleEndian(self.getSetting(setting_code))
 
+    # returns a list with the 7 daily goals (0 = monday)
+    def getGoals(self):
+        setting_codes = [SE_SubCmdSett.GOAL_0.value + i for i in range(7)]
+        return [utils.intFromLittleEndian(buf) for buf in self.getSettings(setting_codes)]
+
     def setFirstname(self,name):
         name_buff = list(bytes(name,'ascii'))
         return self.setSetting(SE_SubCmdSett.FIRST_NAME,name_buff)
@@ -664,54 +1093,233 @@ class FuelbandSE(FuelbandBase):
         subcmd = SE_MemCmds.START_READ if is_read else SE_MemCmds.START_WRITE
         buf = self.send([op_code, subcmd, 0x01, 0x00],report_id=10,verbose=verbose)
         if len(buf) == 1 and buf[0] != 0x00:
+            self.recordError(op_code, buf[0])
             raise MemoryError(buf[0], "Failed to start memory operation!")
 
     def __memoryEndTransaction(self, op_code, **kwargs):
         verbose = kwargs.get('verbose',False)
         buf = self.send([op_code, SE_MemCmds.END_TRANSACTION],report_id=10,verbose=verbose)
         if len(buf) == 1 and buf[0] != 0x00:
+            self.recordError(op_code, buf[0])
             raise MemoryError(buf[0], "Failed to end memory transaction!")
 
     # Start a memory read operation
     # op_code - SE_Opcode.DESKTOP_DATA, SE_Opcode.UPLOAD_GRAPHICS_PACK, or SE_Opcode.MEMORY_EXT???
+    # returns a bytearray with the data that was read
     def __memoryRead(self,op_code,addr,size, **kwargs):
+        read_data = bytearray(size)
+        n_read = self.__memoryReadInto(op_code,addr,read_data,**kwargs)
+        del read_data[n_read:]
+        return read_data
+
+    # Reads memory straight into a preallocated destination buffer
+    # dest - bytearray (or writable memoryview); len(dest) bytes are requested
+    # returns the number of bytes that were actually read
+    def __memoryReadInto(self,op_code,addr,dest, **kwargs):
+        n_read = 0
+        for chunk_addr, chunk in self.__memoryChunks(op_code,addr,len(dest),**kwargs):
+            dest[n_read:n_read + len(chunk)] = chunk
+            n_read += len(chunk)
+        return n_read
+
+    # Generator behind every SE memory read. Opens the read transaction,
+    # yields (address, chunk) as the chunks come in, and closes the
+    # transaction again, also when the consumer stops early. chunks are
+    # memoryviews only valid until the next chunk is requested.
+    def __memoryChunks(self,op_code,addr,size, **kwargs):
         verbose = kwargs.get('verbose',False)
         warn_on_truncated = kwargs.get('warn_on_truncated',True)
+        op_value = op_code.value
+        read_chunk = SE_MemCmds.READ_CHUNK.value
+
+        # start with the largest chunk this firmware is known (or hoped) to
+        # take. lo is the largest size seen working, hi the smallest seen
+        # failing. until they meet we keep searching while we read.
+        chunk_key = (self.getFirmwareKey(), op_value)
+        chunk_size, lo, hi = FuelbandSE.READ_CHUNK_SIZES.get(chunk_key, (MAX_READ_CHUNK, 0, None))
+        fallback = None# (chunk_size, hi) to restore if a guessed cap was wrong
 
         self.__memoryStartOperation(op_code,True,verbose=verbose)
 
-        read_data = []
-        bytes_remaining = size
-        offset = addr
-        cmd_buf = [op_code,SE_MemCmds.READ_CHUNK,0,0,0,0]
-        while bytes_remaining > 0:
-            bytes_this_read = bytes_remaining
-            if bytes_this_read > 58:
-                bytes_this_read = 58
-            cmd_buf[2] = offset & 0xff
-            cmd_buf[3] = (offset >> 8) & 0xff
-            cmd_buf[4] = bytes_this_read & 0xff
-            cmd_buf[5] = (bytes_this_read >> 8) & 0xff
-            rsp = self.send(cmd_buf,report_id=10,verbose=verbose)
-            if len(rsp) >= 1 and rsp[0] != 0x00:
-                raise MemoryError(rsp[0], "Read failed!")
-            if len(rsp) >= 2 and rsp[1] < bytes_this_read:
-                if warn_on_truncated:
-                    print('WARN: truncated read! expected = %d; actual = %d' % (bytes_this_read,rsp[1]))
-                read_data += rsp[2:]
-                break
-            elif len(rsp) >= 2 and rsp[1] > bytes_this_read:
-                print('WARN: read size > than expected! expected = %d; actual = %d' % (bytes_this_read,rsp[1]))
-                read_data += rsp[2:]
-                break
-            else:
-                read_data += rsp[2:]
-            bytes_remaining -= bytes_this_read
-            offset += bytes_this_read
+        n_read = 0
+        done = False
+        try:
+            while not done and n_read < size:
+                cmds = []
+                offset = addr + n_read
+                bytes_remaining = size - n_read
+                while bytes_remaining > 0:
+                    bytes_this_read = min(bytes_remaining, chunk_size)
+                    cmds.append([op_value,read_chunk,
+                        offset & 0xff,(offset >> 8) & 0xff,
+                        bytes_this_read & 0xff,(bytes_this_read >> 8) & 0xff])
+                    bytes_remaining -= bytes_this_read
+                    offset += bytes_this_read
+
+                # chunk requests are pipelined; stop early on the first short chunk
+                done = True
+                rsps = self.sendPipelined(cmds,report_id=10,verbose=verbose)
+                with contextlib.closing(rsps):
+                    for cmd, rsp in zip(cmds, rsps):
+                        bytes_this_read = cmd[4] | (cmd[5] << 8)
+                        settled = lo == chunk_size and (hi is None or hi == lo + 1)
+                        if len(rsp) >= 1 and rsp[0] != 0x00:
+                            if rsp[0] in READ_CHUNK_BACKOFF_ERRORS and not settled and chunk_size > MIN_READ_CHUNK:
+                                # chunk too big for this firmware. retry from here with less
+                                hi = chunk_size
+                                chunk_size = _nextReadChunkSize(lo, hi)
+                                done = False
+                                break
+                            self.recordError(op_code, rsp[0])
+                            raise MemoryError(rsp[0], "Read failed!")
+                        if len(rsp) < 2:
+                            break
+                        n_data = max(0, min(rsp[1], len(rsp) - 2, size - n_read))
+                        if n_data > 0:
+                            yield (addr + n_read, rsp[2:2 + n_data])
+                        n_read += n_data
+                        if rsp[1] < bytes_this_read:
+                            if fallback is not None:
+                                # short again right after guessing a cap, so the
+                                # first short read was really the end of the data
+                                chunk_size, hi = fallback
+                                fallback = None
+                            elif not settled and rsp[1] > 0:
+                                # might be the firmware capping the chunk size.
+                                # keep going with what it gave us to find out.
+                                fallback = (chunk_size, hi)
+                                chunk_size = rsp[1]
+                                hi = chunk_size + 1
+                                done = False
+                                break
+                            if warn_on_truncated:
+                                print('WARN: truncated read! expected = %d; actual = %d' % (bytes_this_read,rsp[1]))
+                            break
+                        elif rsp[1] > bytes_this_read:
+                            print('WARN: read size > than expected! expected = %d; actual = %d' % (bytes_this_read,rsp[1]))
+                            break
+                        elif bytes_this_read == chunk_size:
+                            fallback = None
+                            lo = max(lo, chunk_size)
+                            if hi is not None and hi - lo > 1:
+                                # this size works; see if a bigger one does too
+                                chunk_size = _nextReadChunkSize(lo, hi)
+                                done = False
+                                break
+        finally:
+            # close the transaction however the read ended (consumer stopped
+            # early, rejected chunk, lost responses, ...) so the next memory
+            # operation can start
+            FuelbandSE.READ_CHUNK_SIZES[chunk_key] = (chunk_size, lo, hi)
+            self.__memoryEndTransaction(op_code,verbose=verbose)
+
+    # Writes a block of memory in a single write transaction. the data is
+    # split into the largest WRITE_CHUNK packets a report can carry and the
+    # packets are pipelined (rewriting a chunk is harmless, so resends after
+    # a lost response are safe).
+    # progress - optional function called as progress(bytes_written, total)
+    # returns the number of chunks written
+    def __memoryWrite(self,op_code,addr,data, **kwargs):
+        verbose = kwargs.get('verbose',False)
+        progress = kwargs.get('progress',None)
+        op_value = op_code.value
+        write_chunk = SE_MemCmds.WRITE_CHUNK.value
+        data = memoryview(data).cast('B')
+        size = len(data)
+        if addr + size > 0x10000:
+            raise ValueError('write of %d byte(s) at 0x%04x exceeds the 16bit address space' % (size,addr))
+
+        cmds = []
+        for pos in range(0, size, MAX_WRITE_CHUNK):
+            n_chunk = min(MAX_WRITE_CHUNK, size - pos)
+            offset = addr + pos
+            cmd = [op_value,write_chunk,
+                offset & 0xff,(offset >> 8) & 0xff,
+                n_chunk & 0xff,(n_chunk >> 8) & 0xff]
+            cmd.extend(data[pos:pos + n_chunk])
+            cmds.append(cmd)
+
+        self.__memoryStartOperation(op_code,False,verbose=verbose)
+        try:
+            bytes_written = 0
+            # closing() drains the in-flight writes if we bail out early
+            with contextlib.closing(self.sendPipelined(cmds,report_id=10,verbose=verbose)) as rsps:
+                for cmd, rsp in zip(cmds, rsps):
+                    if len(rsp) >= 1 and rsp[0] != 0x00:
+                        self.recordError(op_code, rsp[0])
+                        raise MemoryError(rsp[0], "Write failed at 0x%04x!" % (cmd[2] | (cmd[3] << 8)))
+                    bytes_written += cmd[4] | (cmd[5] << 8)
+                    if progress: progress(bytes_written, size)
+        finally:
+            # close the transaction however the writes ended (rejected chunk,
+            # lost responses, ...) so the next memory operation can start
+            self.__memoryEndTransaction(op_code,verbose=verbose)
+        return len(cmds)
+
+    # Writes a block of memory and optionally verifies it by reading back
+    # op_code - SE_Opcode.DESKTOP_DATA, SE_Opcode.UPLOAD_GRAPHICS_PACK, or SE_Opcode.MEMORY_EXT
+    # verify - None, 'sample' (first, last and 'verify_samples' evenly spaced
+    #     ranges of 'verify_size' bytes) or 'full'
+    # progress - optional function called as progress(bytes_written, total)
+    # returns a dict with 'bytes', 'chunks', 'elapsed' (seconds spent
+    # writing), 'bytes_per_sec', 'verify_elapsed' and 'verified' (ranges)
+    def writeMemory(self,op_code,addr,data, **kwargs):
+        verify = kwargs.get('verify','sample')
+        verify_samples = kwargs.get('verify_samples',4)
+        verify_size = kwargs.get('verify_size',MAX_READ_CHUNK)
+        data = bytes(data)
+        size = len(data)
+
+        t_start = time.perf_counter()
+        n_chunks = self.__memoryWrite(op_code,addr,data,**kwargs)
+        elapsed = time.perf_counter() - t_start
+
+        verified = []
+        if verify == 'full':
+            verified = [(0, size)]
+        elif verify == 'sample' and size > 0:
+            starts = set([0, max(0, size - verify_size)])
+            for i in range(1, verify_samples + 1):
+                starts.add(size * i // (verify_samples + 1))
+            verified = [(start, min(size, start + verify_size)) for start in sorted(starts)]
+
+        t_verify = time.perf_counter()
+        for start, end in verified:
+            read_back = self.readMemory(op_code, addr + start, end - start)
+            if read_back != data[start:end]:
+                raise RuntimeError('verify failed for 0x%04x-0x%04x' % (addr + start, addr + end))
+        verify_elapsed = time.perf_counter() - t_verify
+
+        return {
+            'bytes' : size,
+            'chunks' : n_chunks,
+            'elapsed' : elapsed,
+            'bytes_per_sec' : size / elapsed if elapsed > 0 else 0.0,
+            'verify_elapsed' : verify_elapsed,
+            'verified' : verified
+        }
 
-        self.__memoryEndTransaction(op_code,verbose=verbose)
+    def writeDesktopData(self,addr,data,**kwargs):
+        return self.writeMemory(SE_Opcode.DESKTOP_DATA,addr,data,**kwargs)
 
-        return read_data
+    def writeGraphicsPackData(self,addr,data,**kwargs):
+        return self.writeMemory(SE_Opcode.UPLOAD_GRAPHICS_PACK,addr,data,**kwargs)
+
+    # Streams a block of memory from any memory opcode
+    # yields (address, chunk) tuples as the chunks arrive. chunks are
+    # memoryviews that are only valid until the next one is requested, so
+    # copy them (or write them out) right away. don't talk to the band while
+    # iterating, requests are still in flight. if the caller stops early the
+    # memory transaction is still closed, ideally use contextlib.closing().
+    def iterMemory(self,op_code,addr,size,**kwargs):
+        kwargs.setdefault('warn_on_truncated',False)
+        return self.__memoryChunks(op_code,addr,size,**kwargs)
+
+    # Reads a block of memory from any memory opcode
+    # op_code - SE_Opcode.DESKTOP_DATA, SE_Opcode.UPLOAD_GRAPHICS_PACK, or SE_Opcode.MEMORY_EXT
+    # returns a bytearray that is shorter than size if the device ran out of data
+    def readMemory(self,op_code,addr,size):
+        return self.__memoryRead(op_code,addr,size,verbose=False,warn_on_truncated=False)
 
     def readDesktopData(self,addr,size):
         return self.__memoryRead(SE_Opcode.DESKTOP_DATA,addr,size,verbose=False,warn_on_truncated=False)
@@ -766,8 +1374,8 @@ class FuelbandSE(FuelbandBase):
         print('Fuel (lifetime): %s' % (self.getLifeTimeFuel()))
 
         DAYS = ['Mon','Tue','Wed','Thu','Fri','Sat','Sun']
-        for d in range(7):
-            print('Goal%d (%s): %s' % (d,DAYS[d],self.getGoal(d)))
+        for d, goal in enumerate(self.getGoals()):
+            print('Goal%d (%s): %s' % (d,DAYS[d],goal))
 
         print('Orientation: %s' % (self.getOrientation()))
 
@@ -815,4 +1423,34 @@ def open_fuelband():
         # no fuelband 2 exists
         pass
 
-    return None
\ No newline at end of file
+    return None
+
+# Lists every connected Fuelband (gen 1 and SE)
+# returns a list of (path, class) tuples that can be passed to
+# open_fuelband_path()
+def enumerate_fuelbands():
+    found = []
+    for fb_class in [Fuelband, FuelbandSE]:
+        for info in hid.enumerate(FuelbandBase.VID, fb_class.PID):
+            found.append((info['path'], fb_class))
+    return found
+
+# Opens the Fuelband at a specific HID device path
+# fb_class - Fuelband or FuelbandSE
+def open_fuelband_path(path, fb_class):
+    device = hid.device()
+    device.open_path(path)
+    device.set_nonblocking(1)
+    return fb_class(device)
+
+# waits for a fuelband to (re)connect to the PC and returns it
+# poll_interval - seconds between attempts to open the band
+def wait_for_fuelband(timeout=10, poll_interval=1.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        fb = open_fuelband()
+        if fb != None:
+            return fb
+        if time.monotonic() >= deadline:
+            raise TimeoutError("couldn't open Fuelband after %ds" % timeout)
+        time.sleep(poll_interval)
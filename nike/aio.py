@@ -0,0 +1,163 @@
+# asyncio API for the nike package.
+#
+# The Async* classes wrap a Fuelband/FuelbandSE object and mirror its public
+# methods as coroutines. Each device gets its own worker thread, so the HID
+# transactions of one device stay serialized while many devices can be
+# driven concurrently from a single event loop without blocking it.
+#
+# Every mirrored coroutine accepts an optional 'timeout' (seconds) on top of
+# the wrapped method's own arguments. Cancelling a call (or hitting its
+# timeout) cancels it if it hasn't started yet. A call that already started
+# runs to completion on the worker thread so multi report transactions, like
+# memory reads, are always closed out on the band.
+#
+# Example:
+#   async def main():
+#       async with await nike.aio.open_fuelband_async() as fb:
+#           print(await fb.getBatteryState(timeout=1.0))
+#   asyncio.run(main())
+import asyncio
+import concurrent.futures
+import functools
+import inspect
+import nike
+
+# methods that aren't mirrored automatically: generators would run on the
+# event loop thread and transact() hands out a view into a reused buffer.
+# generator functions are skipped on their own; this also lists methods
+# that return a generator (see AsyncFuelbandBase.iterMemory())
+_NOT_MIRRORED = ['sendPipelined', 'transact', 'iterMemory', 'iterDump']
+
+# returned by _nextItem() when the generator is exhausted
+_DONE = object()
+
+# copies a memoryview (or the memoryviews in a tuple) out of a reused buffer
+def _copyItem(item):
+    if isinstance(item, memoryview):
+        return bytes(item)
+    if isinstance(item, tuple):
+        return tuple(bytes(x) if isinstance(x, memoryview) else x for x in item)
+    return item
+
+# pulls the next item of a generator (runs on the worker thread)
+def _nextItem(gen):
+    try:
+        return _copyItem(next(gen))
+    except StopIteration:
+        return _DONE
+
+def _asyncMethod(name):
+    async def method(self, *args, timeout=None, **kwargs):
+        return await self.run(getattr(self.fb, name), *args, timeout=timeout, **kwargs)
+    method.__name__ = name
+    method.__qualname__ = name
+    return method
+
+# adds a coroutine to async_cls for every public method of its SYNC_CLASS
+def _mirror(async_cls):
+    for name, func in inspect.getmembers(async_cls.SYNC_CLASS, inspect.isfunction):
+        if name.startswith('_') or name in _NOT_MIRRORED:
+            continue
+        if inspect.isgeneratorfunction(func):
+            continue
+        if name in async_cls.__dict__:
+            continue
+        setattr(async_cls, name, _asyncMethod(name))
+    return async_cls
+
+@_mirror
+class AsyncFuelbandBase(object):
+    SYNC_CLASS = nike.FuelbandBase
+
+    # fb - the Fuelband/FuelbandSE object to wrap
+    # timeout - default timeout in seconds for every call (None = no timeout)
+    def __init__(self, fb, timeout=None):
+        self.fb = fb
+        self.timeout = timeout
+        # a single worker keeps this device's HID transactions in order
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1,
+            thread_name_prefix='fuelband')
+
+    # anything that isn't mirrored (ie. attributes like 'log' or 'metrics')
+    # comes straight from the wrapped object
+    def __getattr__(self, name):
+        if name == 'fb':
+            raise AttributeError(name)
+        return getattr(self.fb, name)
+
+    # runs func(*args, **kwargs) on this device's worker thread
+    async def run(self, func, *args, timeout=None, **kwargs):
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+        if timeout is None:
+            timeout = self.timeout
+        if timeout is None:
+            return await future
+        return await asyncio.wait_for(future, timeout)
+
+    # same as FuelbandBase.sendPipelined(), but returns all the responses
+    async def sendPipelined(self, cmds, timeout=None, **kwargs):
+        def send_all():
+            return [list(buf) for buf in self.fb.sendPipelined(cmds, **kwargs)]
+        return await self.run(send_all, timeout=timeout)
+
+    # same as the wrapped iterMemory() (FuelbandSE), as an async iterator.
+    # every chunk is read on the worker thread and copied, so it stays
+    # valid. timeout applies to each chunk. wrap it in contextlib.aclosing()
+    # when the loop may stop early so the memory transaction gets closed
+    # right away.
+    def iterMemory(self, *args, timeout=None, **kwargs):
+        return self._iterGenerator(self.fb.iterMemory, *args, timeout=timeout, **kwargs)
+
+    # same as the wrapped iterDump() (gen 1 Fuelband), as an async iterator
+    # (see iterMemory())
+    def iterDump(self, *args, timeout=None, **kwargs):
+        return self._iterGenerator(self.fb.iterDump, *args, timeout=timeout, **kwargs)
+
+    # runs the generator func(*args, **kwargs) on the worker thread
+    async def _iterGenerator(self, func, *args, timeout=None, **kwargs):
+        gen = await self.run(func, *args, timeout=timeout, **kwargs)
+        try:
+            while True:
+                item = await self.run(_nextItem, gen, timeout=timeout)
+                if item is _DONE:
+                    break
+                yield item
+        finally:
+            # closes out the memory transaction if we stopped early
+            await self.run(gen.close)
+
+    async def close(self):
+        await self.run(self.fb.device.close)
+        self.executor.shutdown(wait=False)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+@_mirror
+class AsyncFuelband(AsyncFuelbandBase):
+    SYNC_CLASS = nike.Fuelband
+
+@_mirror
+class AsyncFuelbandSE(AsyncFuelbandBase):
+    SYNC_CLASS = nike.FuelbandSE
+
+# wraps an already opened Fuelband/FuelbandSE in its async counterpart
+def wrap(fb, **kwargs):
+    if isinstance(fb, nike.FuelbandSE):
+        return AsyncFuelbandSE(fb, **kwargs)
+    elif isinstance(fb, nike.Fuelband):
+        return AsyncFuelband(fb, **kwargs)
+    return AsyncFuelbandBase(fb, **kwargs)
+
+# async version of nike.open_fuelband(). returns None if no band was found.
+async def open_fuelband_async(**kwargs):
+    loop = asyncio.get_running_loop()
+    fb = await loop.run_in_executor(None, nike.open_fuelband)
+    if fb is None:
+        return None
+    return wrap(fb, **kwargs)
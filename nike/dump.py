@@ -0,0 +1,164 @@
+# Resumable memory dumps.
+#
+# A dump writes the memory it reads into a sparse file and keeps a small
+# sidecar checkpoint ('<file>.ckpt') listing the address ranges that are
+# already on disk. If the band disconnects or reboots mid way, running the
+# same dump again (or letting dump_memory() reconnect) only fetches what is
+# still missing. Only one segment is held in memory at a time.
+#
+# Example:
+#   fb = nike.open_fuelband()
+#   nike.dump.dump_memory(fb, nike.SE_Opcode.UPLOAD_GRAPHICS_PACK, 0x0000,
+#       0x10000, 'graphics_pack.bin', reconnect=nike.wait_for_fuelband)
+import json
+import os
+import nike
+
+CHECKPOINT_VERSION = 1
+
+# merges overlapping/adjacent [start, end) ranges
+def merge_ranges(ranges):
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+# A dump image on disk plus its checkpoint
+# filename - image file; the checkpoint goes in filename + '.ckpt'
+# op_code - memory opcode being dumped (stored to catch mismatched resumes)
+# addr, size - device address range covered by the image
+class CheckpointedDump(object):
+    def __init__(self, filename, op_code, addr, size):
+        self.filename = filename
+        self.ckpt_filename = filename + '.ckpt'
+        self.op_code = op_code
+        self.addr = addr
+        self.size = size
+        self.completed = []# [start, end) offsets relative to addr
+        self.end = None# offset where the device ran out of data
+
+        if os.path.exists(self.ckpt_filename) and os.path.exists(filename):
+            self.__loadCheckpoint()
+        else:
+            # fresh dump. truncate() leaves holes, so the file stays sparse
+            with open(filename, 'wb') as f:
+                f.truncate(size)
+        self.file = open(filename, 'r+b')
+
+    def __loadCheckpoint(self):
+        with open(self.ckpt_filename, 'r') as f:
+            ckpt = json.load(f)
+        expected = (CHECKPOINT_VERSION, self.op_code.name, self.addr, self.size)
+        actual = (ckpt.get('version'), ckpt.get('op_code'), ckpt.get('addr'), ckpt.get('size'))
+        if actual != expected:
+            raise RuntimeError("checkpoint '%s' is for a different dump (%s); delete it to start over" % (
+                self.ckpt_filename, actual))
+        self.completed = merge_ranges(ckpt['completed'])
+        self.end = ckpt.get('end')
+
+    def saveCheckpoint(self):
+        ckpt = {
+            'version' : CHECKPOINT_VERSION,
+            'op_code' : self.op_code.name,
+            'addr' : self.addr,
+            'size' : self.size,
+            'completed' : self.completed,
+            'end' : self.end
+        }
+        # write then rename so a crash never leaves a half written checkpoint
+        tmp_filename = self.ckpt_filename + '.tmp'
+        with open(tmp_filename, 'w') as f:
+            json.dump(ckpt, f)
+        os.replace(tmp_filename, self.ckpt_filename)
+
+    # offset where the dump stops (size, or where the device ran out of data)
+    def limit(self):
+        return self.size if self.end is None else min(self.size, self.end)
+
+    # returns the [start, end) offsets that still need to be read
+    def missingRanges(self):
+        missing = []
+        pos = 0
+        limit = self.limit()
+        for start, end in self.completed:
+            if start >= limit:
+                break
+            if start > pos:
+                missing.append((pos, start))
+            pos = max(pos, end)
+        if pos < limit:
+            missing.append((pos, limit))
+        return missing
+
+    def bytesCompleted(self):
+        return sum(min(end, self.limit()) - start for start, end in self.completed if start < self.limit())
+
+    def isComplete(self):
+        return len(self.missingRanges()) == 0
+
+    # writes data at an offset and records it as completed
+    def write(self, offset, data):
+        self.file.seek(offset)
+        self.file.write(data)
+        self.file.flush()
+        # the data has to be on disk before the checkpoint says it is
+        os.fsync(self.file.fileno())
+        self.completed = merge_ranges(self.completed + [[offset, offset + len(data)]])
+        self.saveCheckpoint()
+
+    # records that the device has no data past offset
+    def markEnd(self, offset):
+        self.end = offset
+        self.saveCheckpoint()
+
+    # trims the image to the data that was actually read and drops the
+    # checkpoint once everything is on disk
+    def finish(self):
+        if self.end is not None:
+            self.file.truncate(self.limit())
+        self.file.close()
+        if self.isComplete():
+            os.remove(self.ckpt_filename)
+
+# Dumps (or resumes dumping) a memory region of a FuelbandSE to a file
+# op_code - SE_Opcode.DESKTOP_DATA, SE_Opcode.UPLOAD_GRAPHICS_PACK, or SE_Opcode.MEMORY_EXT
+# segment_size - bytes read per memory transaction (and per checkpoint)
+# reconnect - optional function returning a reopened band after an OSError
+#     (ie. nike.wait_for_fuelband). without it the OSError is raised and the
+#     dump can be resumed later by calling dump_memory() again.
+# progress - optional function called as progress(bytes_done, bytes_total)
+# returns the number of bytes in the finished image
+def dump_memory(fb, op_code, addr, size, filename, **kwargs):
+    segment_size = kwargs.get('segment_size', 1024)
+    reconnect = kwargs.get('reconnect', None)
+    max_reconnects = kwargs.get('max_reconnects', 5)
+    progress = kwargs.get('progress', None)
+
+    dump = CheckpointedDump(filename, op_code, addr, size)
+    n_reconnects = 0
+    while not dump.isComplete():
+        try:
+            for start, end in dump.missingRanges():
+                for seg_start in range(start, end, segment_size):
+                    seg_size = min(segment_size, end - seg_start)
+                    data = fb.readMemory(op_code, addr + seg_start, seg_size)
+                    if len(data) > 0:
+                        dump.write(seg_start, data)
+                    if progress:
+                        progress(dump.bytesCompleted(), dump.limit())
+                    if len(data) < seg_size:
+                        dump.markEnd(seg_start + len(data))
+                        break
+                if dump.end is not None:
+                    break
+        except OSError:
+            n_reconnects += 1
+            if reconnect is None or n_reconnects > max_reconnects:
+                dump.file.close()
+                raise
+            fb = reconnect()
+    dump.finish()
+    return dump.limit()
@@ -0,0 +1,453 @@
+# In-process emulated Fuelband devices.
+#
+# The classes in this module implement the two HID calls that the nike
+# package uses (send_feature_report/get_feature_report) so that Fuelband and
+# FuelbandSE objects can be driven without a band on the bench. Each emulated
+# device keeps enough state to answer the opcodes that the nike package sends,
+# counts every report that crosses the "bus", and can inject a per-report
+# latency with jitter to approximate a real USB round trip.
+#
+# Example:
+#   import nike.emulator
+#   fb = nike.emulator.open_emulated_fuelband(latency=0.002)
+#   fb.printStatus()
+#   print(fb.device.stats())
+import collections
+import datetime
+import random
+import time
+import nike
+import nike.utils as utils
+from nike import SE_Opcode, SE_SubCmdSett, SE_MemCmds, SE_SubCmdBatt
+
+REPORT_SIZE = 64
+
+# status codes returned in the first byte of a response (see nike.MemoryError)
+STATUS_OK = 0x00
+STATUS_MISSING_FIELDS = 0x01
+STATUS_INVALID_VALUES = 0x02
+STATUS_TRANSACTION_IN_PROGRESS = 0x03
+STATUS_NO_TRANSACTION = 0x04
+
+class EmulatedDevice(object):
+    def __init__(self, **kwargs):
+        # mean time between sending a request and its response being ready
+        self.latency = kwargs.get('latency', 0.0)
+        # extra uniformly distributed delay added on top of 'latency'
+        self.jitter = kwargs.get('jitter', 0.0)
+        self.rand = random.Random(kwargs.get('seed', None))
+        # number of responses the device buffers before dropping the oldest.
+        # lets pipelined transactions keep several requests in flight. real
+        # bands have no such queue (a feature report holds one current
+        # report), so pipelining numbers measured here don't carry over to
+        # hardware. queue_depth=1 behaves like a band.
+        self.queue_depth = kwargs.get('queue_depth', 8)
+        # simulates the band rebooting/unplugging: after this many set reports
+        # every call raises OSError until the device is opened again
+        self.disconnect_after = kwargs.get('disconnect_after', None)
+
+        self.is_open = False
+        self.nonblocking = 0
+        self.pending = collections.deque()# (ready_time, response)
+
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.n_set_reports = 0
+        self.n_get_reports = 0
+        self.n_dropped = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.opcode_counts = {}
+        self.time_created = time.perf_counter()
+
+    def stats(self):
+        return {
+            'set_reports' : self.n_set_reports,
+            'get_reports' : self.n_get_reports,
+            'dropped' : self.n_dropped,
+            'bytes_sent' : self.bytes_sent,
+            'bytes_received' : self.bytes_received,
+            'opcodes' : dict(self.opcode_counts)
+        }
+
+    # hid.device compatible API
+    def open(self, vid=None, pid=None, serial=None):
+        self.is_open = True
+
+    def open_path(self, path):
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+
+    def set_nonblocking(self, v):
+        self.nonblocking = v
+
+    def get_manufacturer_string(self):
+        return 'Nike (emulated)'
+
+    def get_product_string(self):
+        return self.PRODUCT
+
+    def send_feature_report(self, data):
+        self.__checkConnected()
+        if self.disconnect_after is not None and self.n_set_reports >= self.disconnect_after:
+            self.disconnect_after = None
+            self.disconnect()
+            self.__checkConnected()
+        data = bytes(data)
+        report_id = data[0]
+        req_len = data[1]
+        tag = data[2]
+        cmd = data[3:2 + req_len]
+
+        self.n_set_reports += 1
+        self.bytes_sent += len(data)
+        if len(cmd) > 0:
+            self.opcode_counts[cmd[0]] = self.opcode_counts.get(cmd[0], 0) + 1
+
+        payload = self.handle(report_id, cmd)
+        rsp = [report_id, len(payload) + 1, tag] + list(payload)
+        # responses become ready in order, each no earlier than the last one
+        ready_time = self.__readyTime()
+        if len(self.pending) > 0:
+            ready_time = max(ready_time, self.pending[-1][0])
+        if len(self.pending) >= self.queue_depth:
+            self.pending.popleft()
+            self.n_dropped += 1
+        self.pending.append((ready_time, rsp[:REPORT_SIZE]))
+        return len(data)
+
+    def get_feature_report(self, report_id, max_length):
+        self.__checkConnected()
+        self.n_get_reports += 1
+        if len(self.pending) == 0:
+            return []
+        ready_time, rsp = self.pending.popleft()
+        self.__waitUntil(ready_time)
+        rsp = rsp[:max_length]
+        self.bytes_received += len(rsp)
+        return rsp
+
+    # drops off the bus; pending responses are lost
+    def disconnect(self):
+        self.is_open = False
+        self.pending.clear()
+
+    def __checkConnected(self):
+        if not self.is_open:
+            raise OSError('emulated device is not connected')
+
+    def __readyTime(self):
+        delay = self.latency
+        if self.jitter > 0:
+            delay += self.rand.uniform(0.0, self.jitter)
+        return time.perf_counter() + delay
+
+    def __waitUntil(self, ready_time):
+        remaining = ready_time - time.perf_counter()
+        if remaining > 0:
+            time.sleep(remaining)
+
+    # returns the response payload (everything after the tag) for a command.
+    # subclasses implement the actual device behavior; a bare device rejects
+    # every opcode like a band does with one it doesn't know.
+    def handle(self, report_id, cmd):
+        return [STATUS_INVALID_VALUES]
+
+DEFAULT_SE_SETTINGS = {
+    SE_SubCmdSett.SERIAL_NUMBER : list(b'EMU000000001'),
+    SE_SubCmdSett.BAND_COLOR : [0x01],
+    SE_SubCmdSett.GOAL_0 : utils.intToLittleEndian(2000,4),
+    SE_SubCmdSett.GOAL_1 : utils.intToLittleEndian(2000,4),
+    SE_SubCmdSett.GOAL_2 : utils.intToLittleEndian(2000,4),
+    SE_SubCmdSett.GOAL_3 : utils.intToLittleEndian(2000,4),
+    SE_SubCmdSett.GOAL_4 : utils.intToLittleEndian(2000,4),
+    SE_SubCmdSett.GOAL_5 : utils.intToLittleEndian(3000,4),
+    SE_SubCmdSett.GOAL_6 : utils.intToLittleEndian(3000,4),
+    SE_SubCmdSett.FUEL : utils.intToLittleEndian(1234,4),
+    SE_SubCmdSett.CALORIES : utils.intToLittleEndian(456,4),
+    SE_SubCmdSett.STEPS : utils.intToLittleEndian(7890,4),
+    SE_SubCmdSett.WEIGHT : utils.intToLittleEndian(170,2),
+    SE_SubCmdSett.HEIGHT : [70],
+    SE_SubCmdSett.DATE_OF_BIRTH : [1990 & 0xff, (1990 >> 8) & 0xff, 6, 15],
+    SE_SubCmdSett.GENDER : [77],
+    SE_SubCmdSett.HANDEDNESS : [nike.Orientation.LEFT.value],
+    SE_SubCmdSett.LIFETIME_FUEL : utils.intToLittleEndian(987654,4),
+    SE_SubCmdSett.FIRST_NAME : list(b'Emulated')
+}
+
+# Emulates a Fuelband SE
+#
+# memory - dict of SE_Opcode -> bytes used to initialize the memory regions
+#     backing DESKTOP_DATA, UPLOAD_GRAPHICS_PACK and MEMORY_EXT
+# settings - dict of SE_SubCmdSett -> list of bytes overriding the defaults
+# firmware - initial contents of the region written through SE_Opcode.FIRMWARE
+class EmulatedFuelbandSE(EmulatedDevice):
+    PRODUCT = 'FuelBand SE (emulated)'
+    MEMORY_OPCODES = [
+        SE_Opcode.DESKTOP_DATA,
+        SE_Opcode.UPLOAD_GRAPHICS_PACK,
+        SE_Opcode.MEMORY_EXT]
+    MEMORY_CAPACITY = 64 * 1024# 16bit addresses
+    FIRMWARE_CAPACITY = 0x1000000# 24bit addresses (see nike.firmware)
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.initial_settings = dict(DEFAULT_SE_SETTINGS)
+        self.initial_settings.update(kwargs.get('settings', {}))
+        self.initial_memory = kwargs.get('memory', {})
+        self.firmware_prefix = list(kwargs.get('firmware_prefix', b'\x00' * 15))
+        self.model_number = list(kwargs.get('model_number', b'FB-SE-EMU'))
+        self.battery_pct = kwargs.get('battery_pct', 87)
+        self.battery_level = kwargs.get('battery_level', 3950)
+        self.charging = kwargs.get('charging', True)
+        self.status_bytes = list(kwargs.get('status_bytes', [0x00] * 8))
+        # largest READ_CHUNK the emulated firmware accepts. bigger requests are
+        # either rejected (oversize_read='error') or cut short ('truncate')
+        self.max_chunk = kwargs.get('max_chunk', REPORT_SIZE - 5)
+        self.oversize_read = kwargs.get('oversize_read', 'error')
+        # firmware image written through SE_Opcode.FIRMWARE. survives resets
+        self.firmware = bytearray(kwargs.get('firmware', b''))
+        self.factoryReset()
+
+    def factoryReset(self):
+        self.settings = {}
+        for code, value in self.initial_settings.items():
+            self.settings[code.value] = list(value)
+        self.memory = {}
+        for op_code in self.MEMORY_OPCODES:
+            self.memory[op_code.value] = bytearray(self.initial_memory.get(op_code, b''))
+        self.memory[SE_Opcode.FIRMWARE.value] = self.firmware
+        self.transaction = None# (op_code, is_read)
+        self.rtc_offset = datetime.timedelta(0)
+
+    # unplugging/rebooting drops any open memory transaction
+    def disconnect(self):
+        super().disconnect()
+        self.transaction = None
+
+    def handle(self, report_id, cmd):
+        if len(cmd) == 0:
+            return [STATUS_MISSING_FIELDS]
+        op_code = cmd[0]
+        if op_code == SE_Opcode.SETTING_GET.value:
+            return self.handleSettingGet(cmd)
+        elif op_code == SE_Opcode.SETTING_SET.value:
+            return self.handleSettingSet(cmd)
+        elif op_code in self.memory:
+            return self.handleMemory(cmd)
+        elif op_code == SE_Opcode.RTC.value:
+            return self.handleRtc(cmd)
+        elif op_code == SE_Opcode.BATTERY_STATE.value:
+            return self.handleBattery(cmd)
+        elif op_code == SE_Opcode.STATUS.value:
+            return list(self.status_bytes)
+        elif op_code == SE_Opcode.VERSION.value:
+            return self.firmware_prefix + self.model_number
+        elif op_code == SE_Opcode.RESET_STATUS.value:
+            self.factoryReset()
+            return [STATUS_OK]
+        elif op_code == SE_Opcode.PROTOCOL.value:
+            return [STATUS_OK, 6]
+        return [STATUS_INVALID_VALUES]
+
+    def handleSettingGet(self, cmd):
+        if len(cmd) < 3:
+            return [STATUS_MISSING_FIELDS]
+        code = cmd[2]
+        value = self.settings.get(code, [])
+        return [STATUS_OK, 0x01, code, len(value)] + value
+
+    def handleSettingSet(self, cmd):
+        if len(cmd) < 3 or len(cmd) < 3 + cmd[2]:
+            return [STATUS_MISSING_FIELDS]
+        self.settings[cmd[1]] = list(cmd[3:3 + cmd[2]])
+        return [STATUS_OK]
+
+    def handleMemory(self, cmd):
+        if len(cmd) < 2:
+            return [STATUS_MISSING_FIELDS]
+        op_code = cmd[0]
+        subcmd = cmd[1]
+        # firmware chunks use 24bit addresses, everything else 16bit
+        if op_code == SE_Opcode.FIRMWARE.value:
+            addr_len, capacity = 3, self.FIRMWARE_CAPACITY
+        else:
+            addr_len, capacity = 2, self.MEMORY_CAPACITY
+        if subcmd == SE_MemCmds.START_READ.value or subcmd == SE_MemCmds.START_WRITE.value:
+            if self.transaction is not None:
+                return [STATUS_TRANSACTION_IN_PROGRESS]
+            self.transaction = (op_code, subcmd == SE_MemCmds.START_READ.value)
+            return [STATUS_OK]
+        elif subcmd == SE_MemCmds.END_TRANSACTION.value:
+            if self.transaction is None or self.transaction[0] != op_code:
+                return [STATUS_NO_TRANSACTION]
+            self.transaction = None
+            return [STATUS_OK]
+        elif subcmd == SE_MemCmds.READ_CHUNK.value:
+            if self.transaction != (op_code, True):
+                return [STATUS_NO_TRANSACTION]
+            if len(cmd) < 4 + addr_len:
+                return [STATUS_MISSING_FIELDS]
+            addr = utils.intFromLittleEndian(cmd[2:2 + addr_len])
+            size = utils.intFromLittleEndian(cmd[2 + addr_len:4 + addr_len])
+            if size > self.max_chunk:
+                if self.oversize_read == 'error':
+                    return [STATUS_INVALID_VALUES]
+                size = self.max_chunk
+            # data past the end of the region is silently truncated
+            data = self.memory[op_code][addr:addr + size]
+            return [STATUS_OK, len(data)] + list(data)
+        elif subcmd == SE_MemCmds.WRITE_CHUNK.value:
+            if self.transaction != (op_code, False):
+                return [STATUS_NO_TRANSACTION]
+            if len(cmd) < 4 + addr_len:
+                return [STATUS_MISSING_FIELDS]
+            addr = utils.intFromLittleEndian(cmd[2:2 + addr_len])
+            size = utils.intFromLittleEndian(cmd[2 + addr_len:4 + addr_len])
+            data = cmd[4 + addr_len:4 + addr_len + size]
+            if len(data) != size or addr + size > capacity:
+                return [STATUS_INVALID_VALUES]
+            mem = self.memory[op_code]
+            if addr + size > len(mem):
+                mem.extend(bytes(addr + size - len(mem)))
+            mem[addr:addr + size] = data
+            return [STATUS_OK]
+        return [STATUS_INVALID_VALUES]
+
+    def now(self):
+        return datetime.datetime.now() + self.rtc_offset
+
+    def handleRtc(self, cmd):
+        if len(cmd) < 2:
+            return [STATUS_MISSING_FIELDS]
+        subcmd = cmd[1]
+        if subcmd == nike.SUBCMD_RTC_GET_TIME:
+            now = self.now()
+            return [STATUS_OK, now.hour, now.minute, now.second]
+        elif subcmd == nike.SUBCMD_RTC_GET_DATE:
+            now = self.now()
+            return [STATUS_OK, now.year - 2000, now.month, now.day, now.isoweekday()]
+        elif subcmd == nike.SUBCMD_RTC_SET_TIME_DATE:
+            if len(cmd) < 9:
+                return [STATUS_MISSING_FIELDS]
+            hour, minute, sec, year, month, day = cmd[2:8]
+            try:
+                dt_obj = datetime.datetime(2000 + year, month, day, hour, minute, sec)
+            except ValueError:
+                return [STATUS_INVALID_VALUES]
+            self.rtc_offset = dt_obj - datetime.datetime.now()
+            return [STATUS_OK]
+        return [STATUS_INVALID_VALUES]
+
+    def handleBattery(self, cmd):
+        subcmd = cmd[1] if len(cmd) > 1 else SE_SubCmdBatt.QUERY_BATTERY.value
+        if subcmd == SE_SubCmdBatt.QUERY_BATTERY.value:
+            rsp = [STATUS_OK, subcmd, 0x01 if self.charging else 0x00]
+            rsp += utils.intToLittleEndian(self.battery_level,2)
+            rsp += utils.intToLittleEndian(self.battery_pct,2)
+            return rsp
+        elif subcmd == SE_SubCmdBatt.ENABLE_CHARGER.value:
+            self.charging = True
+        elif subcmd == SE_SubCmdBatt.DISABLE_CHARGER.value:
+            self.charging = False
+        return [STATUS_OK]
+
+# Emulates a first generation Fuelband
+#
+# memory - dict of command prefix (bytes) -> bytes served by dumpMemory()
+#     ie. {bytes([0x50, 0x37, 0x36]) : desktop_data, bytes([0x19]) : workouts}
+# log - the text served by the 0xf6 log opcode
+class EmulatedFuelband(EmulatedDevice):
+    PRODUCT = 'FuelBand (emulated)'
+    LOG_CHUNK = REPORT_SIZE - 3
+    DUMP_CHUNK = REPORT_SIZE - 3 - 4
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.memory = kwargs.get('memory', {
+            bytes([0x50, 0x37, 0x36]) : bytes(280),
+            bytes([0x19]) : bytes(0)
+        })
+        log = kwargs.get('log', 'emulated fuelband log\n')
+        if isinstance(log, str):
+            log = log.encode('ascii')
+        self.log = bytearray(log)
+        self.log_offset = 0
+        self.serial_number = list(kwargs.get('serial_number', b'EMU000000001'))
+        self.model_number = list(kwargs.get('model_number', b'FB-EMU'))
+        self.status_bytes = list(kwargs.get('status_bytes', [0x00] * 8))
+        self.battery_pct = kwargs.get('battery_pct', 87)
+        self.battery_mv = kwargs.get('battery_mv', 3950)
+        self.charging = kwargs.get('charging', True)
+        self.orientation = 0x00
+        self.goals = {nike.GOAL_TYPE_CURRENT : 2000, nike.GOAL_TYPE_TOMORROW : 2000}
+
+    # adds text to the end of the emulated system log
+    def appendLog(self, text):
+        self.log += text.encode('ascii') if isinstance(text, str) else text
+
+    def handle(self, report_id, cmd):
+        if len(cmd) == 0:
+            return []
+        op_code = cmd[0]
+        for prefix, data in self.memory.items():
+            if bytes(cmd[:len(prefix)]) == prefix and len(cmd) == len(prefix) + 3:
+                return self.handleDump(data, cmd[len(prefix):])
+        if op_code == 0x08:
+            return [ord('V'), 20, 1, 0x00, 0x00, 0x00, 0x00]
+        elif op_code == 0x06:
+            return [3, 1]
+        elif op_code == 0x60:
+            return [6]
+        elif op_code == 0x02:
+            return [0x00]
+        elif op_code == 0xdf:
+            return list(self.status_bytes)
+        elif op_code == 0xe0:
+            return list(self.model_number)
+        elif op_code == 0xe1:
+            return list(self.serial_number)
+        elif op_code == 0xe2:
+            return [1]
+        elif op_code == 0x13:
+            rsp = [self.battery_pct, 0x59 if self.charging else 0x4e]
+            return rsp + utils.intToBigEndian(self.battery_mv,2)
+        elif op_code == 0x37:
+            if len(cmd) > 1:
+                self.orientation = cmd[1]
+            return [self.orientation]
+        elif op_code == 0x25:
+            goal_type = cmd[1] if len(cmd) > 1 else nike.GOAL_TYPE_CURRENT
+            if len(cmd) > 2:
+                self.goals[goal_type] = utils.intFromBigEndian(cmd[2:5])
+            return [goal_type] + utils.intToBigEndian(self.goals.get(goal_type, 0),2)
+        elif op_code == 0x21:
+            return utils.intToBigEndian(int(time.time()),4)
+        elif op_code == 0x42:
+            return utils.intToBigEndian(0,4)
+        elif op_code == 0xf6:
+            chunk = self.log[self.log_offset:self.log_offset + self.LOG_CHUNK]
+            self.log_offset += len(chunk)
+            return list(chunk)
+        return []
+
+    def handleDump(self, data, offset):
+        offset = utils.intFromBigEndian(offset)
+        chunk = data[offset:offset + self.DUMP_CHUNK]
+        next_offset = offset + len(chunk)
+        status = 0x01 if next_offset < len(data) else 0x00
+        return [status] + utils.intToBigEndian(next_offset,3) + list(chunk)
+
+# Returns a Fuelband/FuelbandSE object backed by an emulated device. All
+# kwargs are passed to the emulated device (latency, jitter, seed, ...).
+def open_emulated_fuelband(se=True, **kwargs):
+    if se:
+        device = EmulatedFuelbandSE(**kwargs)
+        device.open(nike.FuelbandBase.VID, nike.FuelbandSE.PID)
+        return nike.FuelbandSE(device)
+    device = EmulatedFuelband(**kwargs)
+    device.open(nike.FuelbandBase.VID, nike.Fuelband.PID)
+    return nike.Fuelband(device)
@@ -0,0 +1,140 @@
+# Firmware upload for the Fuelband SE.
+#
+# The firmware upgrade protocol hasn't been captured yet, so SE_Opcode.FIRMWARE
+# is driven with the same framing as the other memory opcodes (START_WRITE,
+# WRITE_CHUNK and END_TRANSACTION on report id 10). The only difference is
+# that WRITE_CHUNK carries a 24bit address so images can be bigger than 64KiB:
+#   [FIRMWARE, WRITE_CHUNK, addr (3 bytes LE), len (2 bytes LE), data...]
+#
+# That framing is a guess. nike.emulator accepts exactly it, so uploads to an
+# emulated band don't confirm anything about real hardware, and sending a
+# guessed firmware write to a real band could brick it. upload_firmware()
+# refuses to run unless called with experimental=True.
+#
+# The image is streamed from disk one segment at a time and the chunks of a
+# segment are pipelined, so only one segment is held in memory. If the band
+# drops off the bus part way through (ie. it rebooted into its bootblock) the
+# upload reconnects and resumes after the last chunk the band acknowledged.
+#
+# Example:
+#   fb = nike.open_fuelband()
+#   nike.firmware.upload_firmware(fb, 'firmware.bin', experimental=True, reconnect=nike.wait_for_fuelband)
+import os
+import time
+import nike
+import nike.utils as utils
+from nike import SE_Opcode, SE_MemCmds
+
+# largest WRITE_CHUNK payload: report id, length, tag, opcode, subcmd, 24bit
+# address and 16bit length come before the data
+MAX_FIRMWARE_CHUNK = nike.REPORT_SIZE - 10
+# 24bit addresses
+MAX_FIRMWARE_SIZE = 0x1000000
+
+def _check_status(fb, buf, message):
+    if len(buf) >= 1 and buf[0] != 0x00:
+        fb.recordError(SE_Opcode.FIRMWARE, buf[0])
+        raise nike.MemoryError(buf[0], message)
+
+def start_firmware_write(fb, verbose=False):
+    buf = fb.send([SE_Opcode.FIRMWARE, SE_MemCmds.START_WRITE, 0x01, 0x00],report_id=10,verbose=verbose)
+    _check_status(fb, buf, "Failed to start firmware upload!")
+
+def end_firmware_write(fb, verbose=False):
+    buf = fb.send([SE_Opcode.FIRMWARE, SE_MemCmds.END_TRANSACTION],report_id=10,verbose=verbose)
+    _check_status(fb, buf, "Failed to end firmware upload!")
+
+# Pipelines one segment of the image
+# addr - firmware address of the first byte in data
+# yields the number of bytes in each chunk as the band acknowledges it
+def write_firmware_segment(fb, addr, data, verbose=False):
+    op_value = SE_Opcode.FIRMWARE.value
+    write_chunk = SE_MemCmds.WRITE_CHUNK.value
+    cmds = []
+    for pos in range(0, len(data), MAX_FIRMWARE_CHUNK):
+        n_chunk = min(MAX_FIRMWARE_CHUNK, len(data) - pos)
+        cmd = [op_value,write_chunk]
+        cmd += utils.intToLittleEndian(addr + pos,3)
+        cmd += utils.intToLittleEndian(n_chunk,2)
+        cmd.extend(data[pos:pos + n_chunk])
+        cmds.append(cmd)
+
+    rsps = fb.sendPipelined(cmds,report_id=10,verbose=verbose)
+    try:
+        for cmd, rsp in zip(cmds, rsps):
+            _check_status(fb, rsp, "Firmware write failed at 0x%06x!" % utils.intFromLittleEndian(cmd[2:5]))
+            yield len(cmd) - 7
+    finally:
+        rsps.close()
+
+# Uploads a firmware image from a file to a FuelbandSE
+# experimental - must be True to acknowledge that the upload framing is
+#     unverified (see above). raises RuntimeError otherwise
+# segment_size - bytes read from disk and pipelined at a time
+# reconnect - optional function returning a reopened band after an OSError
+#     (ie. nike.wait_for_fuelband). without it the OSError is raised.
+# progress - optional function called as
+#     progress(bytes_done, bytes_total, bytes_per_sec, eta_seconds)
+# returns a dict with 'bytes', 'elapsed', 'bytes_per_sec', 'reconnects' and
+# 'fuelband' (the band object in use at the end, which differs from fb if
+# the upload had to reconnect)
+def upload_firmware(fb, filename, **kwargs):
+    experimental = kwargs.get('experimental', False)
+    segment_size = kwargs.get('segment_size', 16 * 1024)
+    reconnect = kwargs.get('reconnect', None)
+    max_reconnects = kwargs.get('max_reconnects', 5)
+    progress = kwargs.get('progress', None)
+    verbose = kwargs.get('verbose', False)
+    if not experimental:
+        raise RuntimeError("the firmware upload protocol is unverified; pass experimental=True to use it anyway")
+
+    total = os.path.getsize(filename)
+    if total > MAX_FIRMWARE_SIZE:
+        raise ValueError("firmware image is %d bytes; the band takes at most %d" % (total, MAX_FIRMWARE_SIZE))
+
+    segment = bytearray(segment_size)
+    segment_view = memoryview(segment)
+    done = 0
+    n_reconnects = 0
+    t_start = time.perf_counter()
+    with open(filename, 'rb') as f:
+        while True:
+            try:
+                start_firmware_write(fb, verbose)
+                f.seek(done)
+                while done < total:
+                    n_read = f.readinto(segment)
+                    if n_read == 0:
+                        raise RuntimeError("'%s' shrank during the upload" % filename)
+                    for n_acked in write_firmware_segment(fb, done, segment_view[:n_read], verbose):
+                        done += n_acked
+                        if progress:
+                            elapsed = time.perf_counter() - t_start
+                            rate = done / elapsed if elapsed > 0 else 0.0
+                            eta = (total - done) / rate if rate > 0 else None
+                            progress(done, total, rate, eta)
+                end_firmware_write(fb, verbose)
+                break
+            except (nike.MemoryError, nike.PipelineError):
+                # the band rejected a chunk or stopped answering, but it is
+                # still connected. close the transaction so the upload can
+                # be started over
+                try:
+                    end_firmware_write(fb, verbose)
+                except (nike.MemoryError, OSError):
+                    pass# report the error that stopped the upload instead
+                raise
+            except OSError:
+                n_reconnects += 1
+                if reconnect is None or n_reconnects > max_reconnects:
+                    raise
+                fb = reconnect()
+
+    elapsed = time.perf_counter() - t_start
+    return {
+        'bytes' : total,
+        'elapsed' : elapsed,
+        'bytes_per_sec' : total / elapsed if elapsed > 0 else 0.0,
+        'reconnects' : n_reconnects,
+        'fuelband' : fb
+    }
@@ -0,0 +1,79 @@
+# Streaming reader for the gen 1 Fuelband system log (opcode 0xf6).
+#
+# Every 0xf6 request returns the next piece of the log; an empty response
+# means the band has nothing more right now. LogReader turns those pieces
+# into lines as they arrive, keeps the most recent ones in a ring buffer,
+# optionally copies them to a file, and can keep polling for new output
+# like 'tail -f'.
+#
+# Example:
+#   reader = nike.logreader.LogReader(fb, sink=open('band.log','a'))
+#   for line in reader.readLines(follow=True):
+#       print(line)
+import collections
+import time
+
+class LogReader(object):
+    # fb - an open Fuelband
+    # sink - optional file object every decoded line gets written to
+    # history - number of recent lines kept in self.history
+    def __init__(self, fb, sink=None, history=1000):
+        self.fb = fb
+        self.sink = sink
+        self.history = collections.deque(maxlen=history)
+        self.partial = []# pieces of a line that hasn't been terminated yet
+        self.bytes_read = 0
+
+    # returns the complete lines contained in a raw log chunk
+    def __decode(self, chunk):
+        text = bytes(chunk).decode('latin-1')
+        lines = text.split('\n')
+        if len(lines) == 1:
+            self.partial.append(text)
+            return []
+        lines[0] = ''.join(self.partial) + lines[0]
+        last = lines.pop()
+        self.partial = [last] if len(last) > 0 else []
+        return [line.rstrip('\r') for line in lines]
+
+    def __emit(self, line):
+        self.history.append(line)
+        if self.sink is not None:
+            self.sink.write(line + '\n')
+        return line
+
+    # Yields log lines as they are read from the band
+    # follow - keep polling after the log ran dry (like 'tail -f')
+    # poll_interval - initial wait after an empty read in follow mode. it
+    #     doubles on every empty read up to max_interval and resets once
+    #     data shows up again.
+    # idle_timeout - stop following after this many seconds without data
+    def readLines(self, follow=False, poll_interval=0.05, max_interval=2.0, idle_timeout=None):
+        interval = poll_interval
+        last_data = time.monotonic()
+        while True:
+            chunk = self.fb.readLogChunk()
+            if len(chunk) > 0:
+                self.bytes_read += len(chunk)
+                interval = poll_interval
+                last_data = time.monotonic()
+                for line in self.__decode(chunk):
+                    yield self.__emit(line)
+                continue
+
+            if self.sink is not None:
+                self.sink.flush()
+            if not follow:
+                break
+            if idle_timeout is not None and time.monotonic() - last_data >= idle_timeout:
+                break
+            time.sleep(interval)
+            interval = min(max_interval, interval * 2)
+
+        # whatever is left never got a newline
+        if len(self.partial) > 0:
+            line = ''.join(self.partial)
+            self.partial = []
+            yield self.__emit(line)
+            if self.sink is not None:
+                self.sink.flush()
@@ -0,0 +1,133 @@
+# Runs jobs across many Fuelbands in parallel (ie. a charging rack).
+#
+# Example:
+#   manager = nike.manager.FuelbandManager()
+#   manager.discover()
+#   for result in manager.run(nike.manager.job_status_snapshot):
+#       print(result['path'], result['elapsed'], result['result'])
+import concurrent.futures
+import os
+import time
+import nike
+import nike.firmware
+import nike.utils as utils
+
+# opens the devices found by nike.enumerate_fuelbands(). the manager only
+# needs an object with the same interface, so tests can pass emulated bands.
+class FuelbandManager(object):
+    # fuelbands - optional list of (path, fuelband) tuples that are already open
+    # max_workers - size of the thread pool (defaults to one thread per band)
+    def __init__(self, fuelbands=None, max_workers=None):
+        self.fuelbands = list(fuelbands or [])
+        self.max_workers = max_workers
+        self.open_errors = []# (path, exception) for bands that failed to open
+
+    # opens every connected band that isn't already managed
+    # returns the number of newly opened bands
+    def discover(self):
+        known = set(path for path, fb in self.fuelbands)
+        n_opened = 0
+        for path, fb_class in nike.enumerate_fuelbands():
+            if path in known:
+                continue
+            try:
+                self.fuelbands.append((path, nike.open_fuelband_path(path, fb_class)))
+                n_opened += 1
+            except IOError as ex:
+                self.open_errors.append((path, ex))
+        return n_opened
+
+    def close(self):
+        for path, fb in self.fuelbands:
+            fb.device.close()
+        self.fuelbands = []
+
+    # Runs job(fb, *args, **kwargs) on every band using a bounded thread pool.
+    # Each band only ever runs on one thread at a time.
+    # returns a list of dicts in the same order as self.fuelbands with:
+    #   'path', 'fuelband', 'result' (None on error), 'error' (exception or
+    #   None), 'started' and 'elapsed' (seconds)
+    def run(self, job, *args, **kwargs):
+        max_workers = self.max_workers or max(1, len(self.fuelbands))
+        t_start = time.perf_counter()
+
+        def run_one(path, fb):
+            started = time.perf_counter()
+            result = {
+                'path' : path,
+                'fuelband' : fb,
+                'result' : None,
+                'error' : None,
+                'started' : started - t_start
+            }
+            try:
+                result['result'] = job(fb, *args, **kwargs)
+            except Exception as ex:
+                result['error'] = ex
+            result['elapsed'] = time.perf_counter() - started
+            return result
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = [pool.submit(run_one, path, fb) for path, fb in self.fuelbands]
+            return [future.result() for future in futures]
+
+# returns a dict with the band's status, battery, clock and identity
+def job_status_snapshot(fb):
+    if isinstance(fb, nike.FuelbandSE):
+        return {
+            'model' : fb.getModelNumber(),
+            'serial' : fb.getSerialNumber(),
+            'status' : utils.to_hex(fb.getStatus() or []),
+            'battery' : fb.getBatteryState(),
+            'time' : fb.getTime(),
+            'date' : fb.getDate(),
+            'fuel' : fb.getFuel(),
+            'goals' : fb.getGoals()
+        }
+    fb.doVersion()
+    fb.doSerialNumber()
+    fb.doStatus()
+    fb.doBattery()
+    return {
+        'model' : fb.getModelNumber(),
+        'serial' : fb.serial_number,
+        'firmware' : fb.firmware_version,
+        'status' : utils.to_hex(fb.status_bytes),
+        'battery' : {
+            'percent' : fb.battery_percent,
+            'mv' : fb.battery_mv,
+            'mode' : fb.battery_mode
+        }
+    }
+
+# dumps the band's desktop data to '<out_dir>/<serial>.bin'
+# returns the file name and the number of bytes written
+def job_dump_desktop_data(fb, out_dir, size=4096):
+    if isinstance(fb, nike.FuelbandSE):
+        serial = fb.getSerialNumber()
+        data = fb.readDesktopData(0x0000, size)
+    else:
+        fb.doSerialNumber()
+        serial = fb.serial_number
+        data = fb.dumpMemory([0x50, 0x37, 0x36], size)
+    filename = os.path.join(out_dir, '%s.bin' % (serial or 'unknown'))
+    with open(filename, 'wb') as f:
+        f.write(bytes(data))
+    return {'filename' : filename, 'bytes' : len(data)}
+
+# uploads a firmware image to a Fuelband SE (see nike.firmware). bands that
+# drop off the bus mid upload fail here and can be flashed again on their own
+# experimental - opt in to the unverified upload protocol (see nike.firmware)
+def job_upload_firmware(fb, filename, experimental=False):
+    if not isinstance(fb, nike.FuelbandSE):
+        raise RuntimeError('firmware upload is only supported on the Fuelband SE')
+    result = nike.firmware.upload_firmware(fb, filename, experimental=experimental)
+    del result['fuelband']
+    return result
+
+# sets the band's clock to the host's current time
+def job_set_time(fb):
+    if not isinstance(fb, nike.FuelbandSE):
+        raise RuntimeError('setting the time is only supported on the Fuelband SE')
+    fb.setTimeAndDate()
+    return True
@@ -0,0 +1,208 @@
+# Transport metrics and instrumentation hooks for FuelbandBase.
+#
+# Metrics are off by default. When a FuelbandBase has no metrics object
+# attached, the only cost on the send path is a single 'is None' check per
+# report. Enable them with:
+#   metrics = fb.enableMetrics()
+#   ... talk to the band ...
+#   print(metrics.summary())
+#   metrics.dump(open('metrics.json','w'))
+import json
+import time
+
+# Latency histogram with power of two microsecond buckets. Bucket 'n' holds
+# samples in the range [2^(n-1), 2^n) us; bucket 0 holds samples < 1us.
+class LatencyHistogram(object):
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.buckets = {}
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+        bucket = int(seconds * 1e6).bit_length()
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    # approximate percentile (upper edge of the bucket holding it) in seconds
+    def percentile(self, pct):
+        if self.count == 0:
+            return 0.0
+        rank = pct / 100.0 * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min((1 << bucket) / 1e6, self.max)
+        return self.max
+
+    def toDict(self):
+        return {
+            'count' : self.count,
+            'mean_us' : self.mean() * 1e6,
+            'min_us' : (self.min or 0.0) * 1e6,
+            'max_us' : (self.max or 0.0) * 1e6,
+            'p50_us' : self.percentile(50) * 1e6,
+            'p99_us' : self.percentile(99) * 1e6,
+            'buckets_us' : dict(((1 << b), n) for b, n in sorted(self.buckets.items()))
+        }
+
+class OpcodeStats(object):
+    def __init__(self):
+        self.requests = 0
+        self.responses = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.errors = 0
+        self.retries = 0
+        self.send_latency = LatencyHistogram()
+        self.recv_latency = LatencyHistogram()
+        self.round_trip = LatencyHistogram()
+
+    def toDict(self):
+        return {
+            'requests' : self.requests,
+            'responses' : self.responses,
+            'bytes_sent' : self.bytes_sent,
+            'bytes_received' : self.bytes_received,
+            'errors' : self.errors,
+            'retries' : self.retries,
+            'send_latency' : self.send_latency.toDict(),
+            'recv_latency' : self.recv_latency.toDict(),
+            'round_trip' : self.round_trip.toDict()
+        }
+
+# Collects per opcode counters and latency histograms for every report that
+# FuelbandBase sends and receives.
+#
+# opcode_enum - optional Enum class used to name opcodes (ie. SE_Opcode)
+#
+# Hooks:
+#   pre-send hooks are called as hook(opcode, tag, report) right before the
+#   report goes out. post-receive hooks are called as
+#   hook(opcode, tag, response, round_trip_seconds) after a response came
+#   back. 'report'/'response' are memoryviews only valid during the call.
+class TransportMetrics(object):
+    def __init__(self, opcode_enum=None):
+        self.opcode_enum = opcode_enum
+        self.pre_hooks = []
+        self.post_hooks = []
+        self.reset()
+
+    def reset(self):
+        self.opcodes = {}
+        self.inflight = {}# tag -> (opcode, send start time)
+        self.stale = 0
+        self.io_errors = 0
+        self.time_started = time.time()
+
+    def addPreHook(self, hook):
+        self.pre_hooks.append(hook)
+
+    def addPostHook(self, hook):
+        self.post_hooks.append(hook)
+
+    def removeHook(self, hook):
+        if hook in self.pre_hooks:
+            self.pre_hooks.remove(hook)
+        if hook in self.post_hooks:
+            self.post_hooks.remove(hook)
+
+    def stats(self, opcode):
+        stats = self.opcodes.get(opcode)
+        if stats is None:
+            stats = OpcodeStats()
+            self.opcodes[opcode] = stats
+        return stats
+
+    def opcodeName(self, opcode):
+        if opcode is None:
+            return 'none'
+        if self.opcode_enum is not None:
+            try:
+                return self.opcode_enum(opcode).name
+            except ValueError:
+                pass
+        return '0x%02x' % opcode
+
+    # report - the encoded request (report id, length, tag, opcode, ...)
+    def preSend(self, report):
+        opcode = report[3] if len(report) > 3 else None
+        for hook in self.pre_hooks:
+            hook(opcode, report[2], report)
+
+    def recordSend(self, report, t_start, t_end):
+        opcode = report[3] if len(report) > 3 else None
+        stats = self.stats(opcode)
+        stats.requests += 1
+        stats.bytes_sent += len(report)
+        stats.send_latency.add(t_end - t_start)
+        self.inflight[report[2]] = (opcode, t_start)
+
+    # response - the raw response (report id, length, tag, payload...)
+    def recordRecv(self, response, t_start, t_end):
+        tag = response[2] if len(response) > 2 else None
+        inflight = self.inflight.pop(tag, None)
+        if inflight is None:
+            # empty response or a tag we never sent (or already matched)
+            self.stale += 1
+            return
+        opcode, t_send = inflight
+        round_trip = t_end - t_send
+        stats = self.stats(opcode)
+        stats.responses += 1
+        stats.bytes_received += len(response)
+        stats.recv_latency.add(t_end - t_start)
+        stats.round_trip.add(round_trip)
+        for hook in self.post_hooks:
+            hook(opcode, tag, response, round_trip)
+
+    # err - exception or status code reported for the opcode
+    def recordError(self, opcode, err=None):
+        self.stats(opcode).errors += 1
+        if isinstance(err, OSError):
+            self.io_errors += 1
+
+    def recordRetry(self, opcode):
+        self.stats(opcode).retries += 1
+
+    def toDict(self):
+        out = {
+            'time_started' : self.time_started,
+            'stale_responses' : self.stale,
+            'io_errors' : self.io_errors,
+            'opcodes' : {}
+        }
+        for opcode, stats in self.opcodes.items():
+            out['opcodes'][self.opcodeName(opcode)] = stats.toDict()
+        return out
+
+    # writes all the metrics as json to a file object
+    def dump(self, f):
+        json.dump(self.toDict(), f, indent=2)
+
+    def summary(self):
+        lines = ['%-24s %8s %8s %10s %10s %6s %6s %10s %10s' % (
+            'opcode','reqs','rsps','tx bytes','rx bytes','errs','retry','rtt mean','rtt p99')]
+        for opcode, stats in sorted(self.opcodes.items(), key=lambda item: -item[1].requests):
+            lines.append('%-24s %8d %8d %10d %10d %6d %6d %8.0fus %8.0fus' % (
+                self.opcodeName(opcode),
+                stats.requests,
+                stats.responses,
+                stats.bytes_sent,
+                stats.bytes_received,
+                stats.errors,
+                stats.retries,
+                stats.round_trip.mean() * 1e6,
+                stats.round_trip.percentile(99) * 1e6))
+        lines.append('stale responses: %d; I/O errors: %d' % (self.stale, self.io_errors))
+        return '\n'.join(lines)
@@ -0,0 +1,112 @@
+# Incremental desktop data sync for the Fuelband SE.
+#
+# The last synced desktop data image of every band is kept in a state
+# directory (one '<serial>.bin' plus '<serial>.json' per band). A sync reads
+# the small header region, then re-reads only the tail of the previous image
+# (a little overlap to verify nothing before it moved) and whatever was
+# appended after it. Only when the overlap doesn't match the stored image, or
+# there is no stored image, is everything read again. This relies on the
+# band only rewriting the header and appending after it; edits in the middle
+# of old data outside the overlap window are not detected.
+#
+# Example:
+#   syncer = nike.sync.DesktopDataSync('sync_state')
+#   result = syncer.sync(fb)
+#   print(result['bytes_read'], len(result['image']))
+import json
+import os
+import time
+import nike
+
+class DesktopDataSync(object):
+    # state_dir - where the last synced image of each band is kept
+    # header_size - size of the header region read on every sync
+    # overlap - bytes before the old end re-read to detect moved data
+    # max_size - largest desktop data image we expect
+    # watermark_fn - optional function(header) -> offset of the end of the
+    #     data, for callers that know the header layout. lets a sync skip
+    #     probing for the end of the data.
+    def __init__(self, state_dir, **kwargs):
+        self.state_dir = state_dir
+        self.header_size = kwargs.get('header_size', 128)
+        self.overlap = kwargs.get('overlap', 64)
+        self.max_size = kwargs.get('max_size', 0x10000)
+        self.watermark_fn = kwargs.get('watermark_fn', None)
+        os.makedirs(state_dir, exist_ok=True)
+
+    def imagePath(self, serial):
+        return os.path.join(self.state_dir, '%s.bin' % serial)
+
+    def metaPath(self, serial):
+        return os.path.join(self.state_dir, '%s.json' % serial)
+
+    # returns the last synced image for a serial number (or None)
+    def loadImage(self, serial):
+        try:
+            with open(self.imagePath(serial), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def __saveImage(self, serial, image, meta):
+        for path, mode, content in [
+                (self.imagePath(serial), 'wb', bytes(image)),
+                (self.metaPath(serial), 'w', json.dumps(meta))]:
+            tmp_path = path + '.tmp'
+            with open(tmp_path, mode) as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+
+    # Syncs one band. returns a dict with:
+    #   'serial', 'image' (the full, updated image), 'full' (True if
+    #   everything had to be read), 'bytes_read' (bytes transferred) and
+    #   'ranges' (list of [start, end) ranges fetched from the band)
+    def sync(self, fb):
+        serial = fb.getSerialNumber()
+        old = self.loadImage(serial)
+
+        header = fb.readDesktopData(0x0000, self.header_size)
+        ranges = [[0, len(header)]]
+        bytes_read = len(header)
+
+        end = None
+        if self.watermark_fn is not None:
+            end = min(self.max_size, self.watermark_fn(header))
+
+        full = True
+        image = bytearray(header)
+        if old is not None and len(old) > len(header) and len(header) == self.header_size:
+            # re-read from a bit before the old end to check nothing moved
+            tail_start = max(len(header), len(old) - self.overlap)
+            tail_end = self.max_size if end is None else max(end, tail_start)
+            tail = fb.readDesktopData(tail_start, tail_end - tail_start)
+            ranges.append([tail_start, tail_start + len(tail)])
+            bytes_read += len(tail)
+            n_check = min(len(tail), len(old) - tail_start)
+            if n_check == len(old) - tail_start and tail[:n_check] == old[tail_start:len(old)]:
+                image[len(header):] = old[len(header):tail_start]
+                image += tail
+                full = False
+
+        if full and len(header) == self.header_size:
+            rest_end = self.max_size if end is None else end
+            if rest_end > len(header):
+                rest = fb.readDesktopData(len(header), rest_end - len(header))
+                ranges.append([len(header), len(header) + len(rest)])
+                bytes_read += len(rest)
+                image += rest
+
+        self.__saveImage(serial, image, {
+            'serial' : serial,
+            'size' : len(image),
+            'synced_at' : time.time(),
+            'full' : full,
+            'bytes_read' : bytes_read
+        })
+        return {
+            'serial' : serial,
+            'image' : image,
+            'full' : full,
+            'bytes_read' : bytes_read,
+            'ranges' : ranges
+        }
@@ -2,8 +2,21 @@
 from collections import deque
 from enum import Enum
 import argparse
+import array
+import binascii
+import bisect
+import concurrent.futures
+import hashlib
+import json
+import mmap
 import nike
+import nike.dump
+import nike.emulator
+import nike.metrics
 import nike.utils as utils
+import os
+import re
+import struct
 import time
 
 MAX_BYTES_PER_LINE = 16
@@ -22,45 +35,213 @@ class ReportType(Enum):
     SET_REPORT = 0x00
     GET_REPORT = 0x80
 
+# where the HID report starts in a packet from a macOS text export
+DARWIN_CMD_OFFSET = 32
+
+# PacketList's marker for packets without a timestamp
+NO_TIMESTAMP = float('nan')
+
+# value -> member lookups that skip the (slow) Enum constructor
+REQUEST_TYPES = dict((t.value, t) for t in RequestType)
+REPORT_TYPES = dict((t.value, t) for t in ReportType)
+
+# A captured USB packet. Packets don't own their bytes; they reference a
+# buffer that is shared with the other packets of the capture, and header
+# fields are only decoded when they are first used.
+# buf - buffer holding the packet (converted to a memoryview)
+# start, end - where the packet is in buf (end defaults to the end of buf)
+# cmd_offset - where the HID report starts in the packet
+# request_type, report_type - decoded from the macOS USB header in the
+#     packet when not given
+# timestamp - capture time in seconds (None for text exports)
 class Packet(object):
-    def __init__(self, id, data):
+    __slots__ = ('id', 'buf', 'start', 'end', 'cmd_offset', 'timestamp', '_request_type', '_report_type')
+
+    def __init__(self, id, buf, start=0, end=None, cmd_offset=DARWIN_CMD_OFFSET, timestamp=None, request_type=None, report_type=None):
+        if not isinstance(buf, memoryview):
+            buf = memoryview(buf)
         self.id = id
-        self.data = bytearray()
-        self.data[:] = data # store copy of data
-        self.request_type = RequestType(data[3])
-        self.report_type = ReportType(data[30] & 0x80)
+        self.buf = buf
+        self.start = start
+        self.end = len(buf) if end is None else end
+        self.cmd_offset = cmd_offset
+        self.timestamp = timestamp
+        self._request_type = request_type
+        self._report_type = report_type
+
+    # the packet's bytes (a view into the shared buffer)
+    @property
+    def data(self):
+        return self.buf[self.start:self.end]
+
+    @property
+    def request_type(self):
+        if self._request_type is None:
+            value = self.buf[self.start + 3]
+            self._request_type = REQUEST_TYPES.get(value) or RequestType(value)
+        return self._request_type
+
+    @property
+    def report_type(self):
+        if self._report_type is None:
+            self._report_type = REPORT_TYPES[self.buf[self.start + 30] & 0x80]
+        return self._report_type
+
+    # keyword arguments that make a copy of this packet's metadata
+    def pkt_kwargs(self):
+        return {
+            'cmd_offset' : self.cmd_offset,
+            'timestamp' : self.timestamp,
+            'request_type' : self._request_type,
+            'report_type' : self._report_type
+        }
+
+# Compact list of the packets in a capture. Only the offsets and metadata
+# of each packet are stored (in arrays); Packet objects are created when a
+# packet is accessed and reference the capture's shared buffer.
+# buf - the buffer holding every packet (ie. the mmap'd capture). it must
+#     not be resized once packets are accessed.
+class PacketList(object):
+    def __init__(self, buf):
+        self.buf = buf
+        self.view = None
+        self.ids = None# packet numbers, when they aren't just the indexes
+        self.starts = array.array('q')
+        self.ends = array.array('q')
+        self.cmd_offsets = array.array('H')
+        self.timestamps = array.array('d')# nan -> no timestamp
+        # raw RequestType/ReportType values. values that aren't members are
+        # decoded (and rejected) when the packet is accessed
+        self.request_types = array.array('h')
+        self.report_types = array.array('h')
+
+    def append(self, start, end, cmd_offset, timestamp, request_type, report_type):
+        self.starts.append(start)
+        self.ends.append(end)
+        self.cmd_offsets.append(cmd_offset)
+        self.timestamps.append(NO_TIMESTAMP if timestamp is None else timestamp)
+        self.request_types.append(request_type)
+        self.report_types.append(report_type)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self.starts)
+        if self.view is None:
+            self.view = memoryview(self.buf)
+        timestamp = self.timestamps[idx]
+        pkt_id = idx if self.ids is None else self.ids[idx]
+        return Packet(pkt_id, self.view, self.starts[idx], self.ends[idx],
+            cmd_offset=self.cmd_offsets[idx],
+            timestamp=None if timestamp != timestamp else timestamp,
+            request_type=REQUEST_TYPES.get(self.request_types[idx]),
+            report_type=REPORT_TYPES.get(self.report_types[idx]))
+
+    def __iter__(self):
+        for idx in range(len(self.starts)):
+            yield self[idx]
+
+    # returns the arrays for packets [start, end) (ie. to pickle them)
+    def columns(self, start, end):
+        return (
+            self.starts[start:end],
+            self.ends[start:end],
+            self.cmd_offsets[start:end],
+            self.timestamps[start:end],
+            self.request_types[start:end],
+            self.report_types[start:end])
+
+    # makes a PacketList from arrays returned by columns()
+    @classmethod
+    def from_columns(cls, buf, columns):
+        pkts = cls(buf)
+        (pkts.starts, pkts.ends, pkts.cmd_offsets, pkts.timestamps,
+            pkts.request_types, pkts.report_types) = columns
+        return pkts
+
+    # yields only the packets of the given request and report type, without
+    # creating Packet objects for the others
+    def select(self, request_type, report_type):
+        request_value = request_type.value
+        report_value = report_type.value
+        for idx, types in enumerate(zip(self.request_types, self.report_types)):
+            if types[0] == request_value and types[1] == report_value:
+                yield self[idx]
 
+# A SET_REPORT request. Fields are decoded from the HID report on first use.
 class Request(Packet):
+    __slots__ = ('pkt', '_opcode', '_subcmd')
+
     def __init__(self, pkt):
-        super(Request, self).__init__(pkt.id, pkt.data)
+        super(Request, self).__init__(pkt.id, pkt.buf, pkt.start, pkt.end, **pkt.pkt_kwargs())
         self.pkt = pkt
+        self._opcode = None
+        self._subcmd = None# (code, len, val) once decoded
+
+    @property
+    def report_id(self):
+        return self.buf[self.start + self.cmd_offset]
+
+    @property
+    def req_len(self):
+        return self.buf[self.start + self.cmd_offset + 1]
+
+    @property
+    def tag(self):
+        return self.buf[self.start + self.cmd_offset + 2]
 
-        FB_CMD_OFFSET = 32 # 32 -> Mac, 36 -> Linux
-        self.report_id = self.data[FB_CMD_OFFSET]
-        self.req_len = self.data[FB_CMD_OFFSET + 1]
-        self.tag = self.data[FB_CMD_OFFSET + 2]
-        self.opcode = nike.SE_Opcode(self.data[FB_CMD_OFFSET + 3])
-        self.payload = self.data[FB_CMD_OFFSET + 4:FB_CMD_OFFSET + 4 + self.req_len - 1]
-        self.subcmd_code = None
-        self.subcmd_len = 0
-        self.subcmd_val = []
-        if self.opcode == nike.SE_Opcode.SETTING_SET:
-            self.subcmd_code = nike.SE_SubCmdSett(self.payload[0])
-            self.subcmd_len = int(self.payload[1])
-            self.subcmd_val = self.payload[2:2+self.subcmd_len]
-        elif self.opcode == nike.SE_Opcode.SETTING_GET:
-            length = int(self.payload[0])
+    @property
+    def opcode(self):
+        if self._opcode is None:
+            self._opcode = nike.SE_Opcode(self.buf[self.start + self.cmd_offset + 3])
+        return self._opcode
+
+    @property
+    def payload(self):
+        offset = self.start + self.cmd_offset + 4
+        return self.buf[offset:min(offset + self.req_len - 1, self.end)]
+
+    def __decodeSubcmd(self):
+        subcmd_code = None
+        subcmd_len = 0
+        subcmd_val = []
+        opcode = self.opcode
+        if opcode == nike.SE_Opcode.SETTING_SET:
+            payload = self.payload
+            subcmd_code = nike.SE_SubCmdSett(payload[0])
+            subcmd_len = int(payload[1])
+            subcmd_val = payload[2:2+subcmd_len]
+        elif opcode == nike.SE_Opcode.SETTING_GET:
+            payload = self.payload
+            length = int(payload[0])
             if length != 1:
                 raise RuntimeError("SETTING_GET request should have length == 1, but it's %d" % length)
-            self.subcmd_code = nike.SE_SubCmdSett(self.payload[1])
-        elif self.opcode == nike.SE_Opcode.BATTERY_STATE:
-            self.subcmd_code = nike.SE_SubCmdBatt(self.payload[0])
+            subcmd_code = nike.SE_SubCmdSett(payload[1])
+        elif opcode == nike.SE_Opcode.BATTERY_STATE:
+            subcmd_code = nike.SE_SubCmdBatt(self.payload[0])
+        self._subcmd = (subcmd_code, subcmd_len, subcmd_val)
+        return self._subcmd
+
+    @property
+    def subcmd_code(self):
+        return (self._subcmd or self.__decodeSubcmd())[0]
+
+    @property
+    def subcmd_len(self):
+        return (self._subcmd or self.__decodeSubcmd())[1]
+
+    @property
+    def subcmd_val(self):
+        return (self._subcmd or self.__decodeSubcmd())[2]
 
     # replay the request to a real fuelband device
+    # kwargs - passed on to send() (ie. trim)
     # returns the response buffer from the device
-    def send_to_device(self, fb_dev):
+    def send_to_device(self, fb_dev, **kwargs):
         cmd = [self.opcode]
-        # payload is bytearray and can't append lists with bytearrays,
+        # payload is a memoryview and can't append lists with memoryviews,
         # soooo.... lazily append bytes onto our command list
         for data in self.payload:
             cmd.append(data)
@@ -69,7 +250,8 @@ class Request(Packet):
         return fb_dev.send(
             cmd,
             report_id=self.report_id,
-            tag=self.tag)
+            tag=self.tag,
+            **kwargs)
 
     def pretty_str(self, **kwargs):
         out  = "req - "
@@ -99,14 +281,31 @@ class GraphicsPack(Request):
         return out
 
 class GenericMemoryBlock(Request):
+    __slots__ = ('_rw_mode',)
+
     def __init__(self, pkt):
         super(GenericMemoryBlock, self).__init__(pkt)
-        self.rw_mode = nike.SE_MemCmds(self.payload[0])
-        self.address = utils.intFromLittleEndian(self.payload[1:3])
-        self.mem_len = utils.intFromLittleEndian(self.payload[3:5])
-        self.mem = []
+        self._rw_mode = None
+
+    @property
+    def rw_mode(self):
+        if self._rw_mode is None:
+            self._rw_mode = nike.SE_MemCmds(self.payload[0])
+        return self._rw_mode
+
+    @property
+    def address(self):
+        return utils.intFromLittleEndian(self.payload[1:3])
+
+    @property
+    def mem_len(self):
+        return utils.intFromLittleEndian(self.payload[3:5])
+
+    @property
+    def mem(self):
         if self.rw_mode == nike.SE_MemCmds.WRITE_CHUNK:
-            self.mem = self.payload[5:5+self.mem_len]
+            return self.payload[5:5+self.mem_len]
+        return []
 
     def pretty_str(self, **kwargs):
         out  = "req - "
@@ -118,6 +317,8 @@ class GenericMemoryBlock(Request):
         return out
 
 class UploadGraphicsPack(GenericMemoryBlock):
+    __slots__ = ()
+
     def __init__(self, pkt):
         super(UploadGraphicsPack, self).__init__(pkt)
 
@@ -128,30 +329,186 @@ def upcast_request(req):
         return GenericMemoryBlock(req.pkt)
     return req
 
+# A GET_REPORT response. Fields are decoded from the HID report on use.
 class Response(Packet):
+    __slots__ = ()
+
     def __init__(self, pkt):
-        super(Response, self).__init__(pkt.id, pkt.data)
+        super(Response, self).__init__(pkt.id, pkt.buf, pkt.start, pkt.end, **pkt.pkt_kwargs())
 
+    @property
+    def report_id(self):
+        return self.buf[self.start + self.cmd_offset]
+
+    @property
+    def rsp_len(self):
+        return self.buf[self.start + self.cmd_offset + 1]
+
+    @property
+    def tag(self):
+        return self.buf[self.start + self.cmd_offset + 2]
+
+    # what the band answered (what FuelbandBase.send() returns, minus the
+    # padding of the report)
+    @property
+    def payload(self):
+        offset = self.start + self.cmd_offset + 3
+        return self.buf[offset:min(offset + self.rsp_len - 1, self.end)]
+
+    # first byte of the answer; 0x00 when the request succeeded
+    @property
+    def status(self):
+        payload = self.payload
+        return payload[0] if len(payload) > 0 else None
+
+    # latency - optional seconds since the request was sent
+    def pretty_str(self, **kwargs):
+        latency = kwargs.get('latency', None)
+        payload = self.payload
+        out  = "rsp - "
+        if self.status is not None:
+            out += "status: 0x%02x; " % self.status
+        out += "rsp_len: %d; " % len(payload)
+        if latency is not None:
+            out += "latency: %.3fms; " % (latency * 1e3)
+        if len(payload) > 1:
+            out += "\n%s" % utils.to_hex_with_ascii(payload[1:], indent=4)
+        return out
+
+# Sparse memory image rebuilt from captured writes.
+#
+# Written bytes live in sorted, non-overlapping extents (one bytearray per
+# contiguous run), so memory use follows the bytes actually written rather
+# than the highest address. A second sorted list of ranges records which
+# packet last wrote each byte.
+# size - minimum size of the exported image (holes are zero filled)
 class MemDump(object):
-    def __init__(self, size):
-        self.mem = bytearray(size)
-    
-    def resize(self, new_size):
-        old_mem = self.mem
-        self.mem = bytearray(new_size)
-        n_to_copy = min(new_size, len(old_mem))
-        for i in range(n_to_copy):
-            self.mem[i] = old_mem[i]
-    
-    def add_block(self, at_idx, block):
+    def __init__(self, size=0):
+        self.size = size
+        # extents: starts[k] <= address < ends[k] is in datas[k]
+        self.starts = []
+        self.ends = []
+        self.datas = []
+        # last writers: w_starts[k] <= address < w_ends[k] written by w_ids[k]
+        self.w_starts = []
+        self.w_ends = []
+        self.w_ids = []
+        self.n_overwritten = 0# bytes written more than once
+
+    # size of the flat image
+    def __len__(self):
+        return max(self.size, self.ends[-1] if self.ends else 0)
+
+    def add_block(self, at_idx, block, pkt_id=None):
         block_len = len(block)
-        req_size = at_idx + block_len
-        # resize our memory if block goes past the end
-        if req_size > len(self.mem):
-            self.resize(req_size)
-        # insert block into our memory at given start idx
-        for i in range(block_len):
-            self.mem[at_idx + i] = block[i]
+        if block_len == 0:
+            return
+        end = at_idx + block_len
+        self.__addWriter(at_idx, end, pkt_id)
+
+        # extents that overlap or touch the block get merged with it
+        lo = bisect.bisect_left(self.ends, at_idx)
+        hi = bisect.bisect_right(self.starts, end)
+        if lo == hi:
+            self.starts.insert(lo, at_idx)
+            self.ends.insert(lo, end)
+            self.datas.insert(lo, bytearray(block))
+        elif hi - lo == 1 and self.starts[lo] <= at_idx:
+            # overwrites and/or extends a single extent in place. the slice
+            # is clipped to the extent, so writing past its end grows it
+            offset = at_idx - self.starts[lo]
+            self.datas[lo][offset:offset + block_len] = block
+            self.ends[lo] = max(self.ends[lo], end)
+        else:
+            new_start = min(self.starts[lo], at_idx)
+            new_end = max(self.ends[hi - 1], end)
+            merged = bytearray(new_end - new_start)
+            for k in range(lo, hi):
+                merged[self.starts[k] - new_start:self.ends[k] - new_start] = self.datas[k]
+            merged[at_idx - new_start:end - new_start] = block
+            self.starts[lo:hi] = [new_start]
+            self.ends[lo:hi] = [new_end]
+            self.datas[lo:hi] = [merged]
+
+    def __addWriter(self, start, end, pkt_id):
+        # ranges the write overlaps (touching ones are left alone)
+        lo = bisect.bisect_right(self.w_ends, start)
+        hi = bisect.bisect_left(self.w_starts, end)
+        starts = [start]
+        ends = [end]
+        ids = [pkt_id]
+        if lo < hi:
+            for k in range(lo, hi):
+                self.n_overwritten += min(end, self.w_ends[k]) - max(start, self.w_starts[k])
+            # keep what sticks out on either side
+            if self.w_starts[lo] < start:
+                starts.insert(0, self.w_starts[lo])
+                ends.insert(0, start)
+                ids.insert(0, self.w_ids[lo])
+            if self.w_ends[hi - 1] > end:
+                starts.append(end)
+                ends.append(self.w_ends[hi - 1])
+                ids.append(self.w_ids[hi - 1])
+        self.w_starts[lo:hi] = starts
+        self.w_ends[lo:hi] = ends
+        self.w_ids[lo:hi] = ids
+
+    # returns the id of the packet that last wrote address, None if nothing did
+    def writer(self, address):
+        k = bisect.bisect_right(self.w_starts, address) - 1
+        if k >= 0 and address < self.w_ends[k]:
+            return self.w_ids[k]
+        return None
+
+    # yields (start, end, pkt_id) for every range, by address
+    def writers(self):
+        return zip(self.w_starts, self.w_ends, self.w_ids)
+
+    # yields (start, bytes) for every extent, by address
+    def extents(self):
+        return zip(self.starts, self.datas)
+
+    # returns bytes [start, end) of the image, holes zero filled
+    def read(self, start, end):
+        out = bytearray(end - start)
+        k = max(0, bisect.bisect_right(self.starts, start) - 1)
+        while k < len(self.starts) and self.starts[k] < end:
+            lo = max(start, self.starts[k])
+            hi = min(end, self.ends[k])
+            if lo < hi:
+                out[lo - start:hi - start] = memoryview(self.datas[k])[lo - self.starts[k]:hi - self.starts[k]]
+            k += 1
+        return out
+
+    # the whole image as one bytearray
+    @property
+    def mem(self):
+        return self.read(0, len(self))
+
+    # writes the whole image to f, holes zero filled
+    def write_flat(self, f):
+        pos = 0
+        for start, data in self.extents():
+            if start > pos:
+                f.write(bytes(start - pos))
+            f.write(data)
+            pos = start + len(data)
+        if len(self) > pos:
+            f.write(bytes(len(self) - pos))
+
+    # writes the image to f (a seekable file) leaving holes unwritten, so
+    # the file is sparse on filesystems that support it
+    def write_sparse(self, f):
+        base = f.tell()
+        end = 0
+        for start, data in self.extents():
+            f.seek(base + start)
+            f.write(data)
+            end = start + len(data)
+        if len(self) > end:
+            # a trailing hole still needs the file to reach its full size
+            f.seek(base + len(self) - 1)
+            f.write(b'\x00')
 
 def parse_pkts_from_file(pcap_file, **kwargs):
     max_pkts = kwargs.get('max_pkts', None)
@@ -169,7 +526,7 @@ def parse_pkts_from_file(pcap_file, **kwargs):
                 utils.print_hex_with_ascii(pkt_data)
             
             if len(pkt_data) >= 35:
-                pkts.append(Packet(pkt_idx, pkt_data))
+                pkts.append(Packet(pkt_idx, bytes(pkt_data)))
                 pkt_idx += 1
 
                 if max_pkts and pkt_idx >= max_pkts:
@@ -184,82 +541,1366 @@ def parse_pkts_from_file(pcap_file, **kwargs):
     
     return pkts
 
-# waits for fuelband device to reconnect to PC and returns it
-def wait_for_device(timeout=10):
-    for i in range(timeout):
-        fb = nike.open_fuelband()
-        if fb == None:
-            time.sleep(1.0)
+# returns the contents of a capture file without copying it when possible
+# pcap_file - file object, or an already loaded buffer (returned as is)
+def map_file(pcap_file):
+    if isinstance(pcap_file, (bytes, bytearray, memoryview, mmap.mmap)):
+        return pcap_file
+    try:
+        return mmap.mmap(pcap_file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, OSError, ValueError):
+        # pipes and empty files can't be mapped
+        return pcap_file.read()
+
+# characters that can show up between the hex digits of a data column
+HEX_WHITESPACE = b' \t\r\n'
+# the data column of a line (the '\n' in front of the line included)
+DATA_COLUMN_RE = re.compile(rb'\n.{%d}(.{%d}.?)' % (DATA_START_IDX, DATA_WIDTH - 1))
+
+# Fast version of parse_pkts_from_file() that produces the same packets.
+# Works on raw bytes instead of decoded lines: packets are split at blank
+# lines, a regular expression pulls out all the data columns of a packet at
+# once, and the columns are converted in one binascii call. Regular files
+# are mmap'd and scanned in large blocks rather than read line by line.
+# block_size - approximate number of bytes scanned at a time
+# text_spans - optional array that gets the [start, end) offsets of the
+#     text each packet was parsed from (two entries per packet). parsing
+#     just that text again yields just that packet.
+def parse_pkts_fast(pcap_file, **kwargs):
+    max_pkts = kwargs.get('max_pkts', None)
+    block_size = kwargs.get('block_size', 16 * 1024 * 1024)
+    text_spans = kwargs.get('text_spans', None)
+
+    buf = map_file(pcap_file)
+    cols = []# data columns of the packet being parsed
+    # the packets are decoded one after the other into a shared buffer
+    shared = bytearray()
+    pkts = PacketList(shared)
+    pkt_text_start = 0# offset in buf after the last short line
+
+    # ends the packet being parsed at the short line that ends at offset
+    # 'boundary' of buf. returns False once max_pkts is reached
+    def end_pkt(boundary):
+        nonlocal pkt_text_start
+        text_start = pkt_text_start
+        pkt_text_start = boundary
+        if len(cols) == 0:
+            return True
+        pkt_data = binascii.a2b_hex(b''.join(cols).translate(None, HEX_WHITESPACE))
+        cols.clear()
+        if len(pkt_data) >= 35:
+            pkts.append(len(shared), len(shared) + len(pkt_data),
+                DARWIN_CMD_OFFSET, None, pkt_data[3], pkt_data[30] & 0x80)
+            shared.extend(pkt_data)
+            if text_spans is not None:
+                text_spans.append(text_start)
+                text_spans.append(boundary)
+            if max_pkts and len(pkts) >= max_pkts:
+                return False
+        return True
+
+    # adds the lines between the '\n' at 'start' and the one at 'end'
+    # block_offset - offset in buf of block[0]
+    def add_lines(block, block_offset, start, end):
+        run_cols = DATA_COLUMN_RE.findall(block, start, end)
+        if len(run_cols) == block.count(b'\n', start, end):
+            # common case: no short lines in between
+            cols.extend(run_cols)
+            return True
+        line_offset = block_offset + start + 1
+        for line in block[start + 1:end].split(b'\n'):
+            line_offset += len(line) + 1
+            # same test as the slow parser, minus the '\n'
+            if len(line) >= DATA_END_IDX - 1:
+                cols.append(line[DATA_START_IDX:DATA_END_IDX])
+            elif not end_pkt(min(line_offset, size)):
+                return False
+        return True
+
+    pos = 0
+    size = len(buf)
+    while pos < size:
+        end = buf.find(b'\n', pos + block_size)
+        if end < 0:
+            end = size - 1
+        # blocks start with the '\n' in front of their first line and end
+        # with the '\n' of their last line
+        if pos == 0:
+            block = b'\n' + buf[0:end + 1]
         else:
-            return fb
-    raise TimeoutError("couldn't open Fuelband after %ds" % timeout)
+            block = buf[pos - 1:end + 1]
+        if end == size - 1 and block[-1:] != b'\n':
+            last_nl = block.rfind(b'\n')
+            if len(block) - last_nl - 1 >= DATA_END_IDX:
+                # a long last line without a '\n' never gets its packet ended
+                block = block[:last_nl + 1]
+            else:
+                # ... and a short one ends it, no matter its length
+                block = block[:last_nl + 1] + b'\n'
+        # block[0] is the '\n' in front of buf[pos]
+        block_offset = pos - 1
+        pos = end + 1
 
-# extracts all Fuelband requests from pkts list
-def get_all_requests(pkts):
-    requests = deque()
-    for idx, pkt in enumerate(pkts):
+        run_start = 0# the '\n' in front of the current run of lines
+        while True:
+            blank = block.find(b'\n\n', run_start)
+            if blank < 0:
+                # packet continues in the next block
+                if not add_lines(block, block_offset, run_start, len(block) - 1):
+                    return pkts
+                break
+            if not add_lines(block, block_offset, run_start, blank):
+                return pkts
+            if not end_pkt(min(block_offset + blank + 2, size)):
+                return pkts
+            run_start = blank + 1
+    return pkts
+
+PCAP_MAGIC_USEC = 0xa1b2c3d4
+PCAP_MAGIC_NSEC = 0xa1b23c4d
+PCAPNG_SECTION_HEADER = 0x0a0d0d0a
+PCAPNG_BYTE_ORDER_MAGIC = 0x1a2b3c4d
+PCAPNG_INTERFACE_DESCRIPTION = 0x00000001
+PCAPNG_PACKET = 0x00000002# obsolete
+PCAPNG_SIMPLE_PACKET = 0x00000003
+PCAPNG_ENHANCED_PACKET = 0x00000006
+PCAPNG_OPT_END = 0
+PCAPNG_OPT_IF_TSRESOL = 9
+
+# link types of USB captures
+LINKTYPE_USB_LINUX = 189
+LINKTYPE_USB_LINUX_MMAPPED = 220
+LINKTYPE_USB_DARWIN = 266
+
+# Linux usbmon packet header (the mmapped variant adds 16 more bytes)
+#   urb id, event type, transfer type, endpoint, device, bus, setup flag,
+#   data flag, seconds, microseconds, status, urb length, captured length,
+#   setup packet
+USBMON_HEADER = '%sQBBBBHbbqiiII8s'
+USBMON_HEADER_LEN = 48
+USBMON_MMAPPED_HEADER_LEN = 64
+USBMON_SUBMIT = ord('S')
+USBMON_COMPLETE = ord('C')
+USB_TRANSFER_CONTROL = 2
+
+# returns True if buf starts like a libpcap or pcapng file
+def is_pcap(buf):
+    if len(buf) < 4:
+        return False
+    magic = struct.unpack_from('<I', buf, 0)[0]
+    swapped = struct.unpack_from('>I', buf, 0)[0]
+    return magic == PCAPNG_SECTION_HEADER or PCAP_MAGIC_USEC in (magic, swapped) or PCAP_MAGIC_NSEC in (magic, swapped)
+
+# yields (link_type, byte_order, timestamp, start, end) for each record of
+# a libpcap file; the frame is buf[start:end]. byte_order is the struct
+# prefix ('<' or '>') of the writer.
+def iter_pcap_frames(buf):
+    byte_order = '<'
+    magic = struct.unpack_from('<I', buf, 0)[0]
+    if magic not in (PCAP_MAGIC_USEC, PCAP_MAGIC_NSEC):
+        byte_order = '>'
+        magic = struct.unpack_from('>I', buf, 0)[0]
+    ts_scale = 1e-9 if magic == PCAP_MAGIC_NSEC else 1e-6
+    # the upper bits of the link type field hold FCS info
+    link_type = struct.unpack_from(byte_order + 'I', buf, 20)[0] & 0xffff
+
+    record = struct.Struct(byte_order + 'IIII')
+    pos = 24
+    while pos + record.size <= len(buf):
+        ts_sec, ts_frac, incl_len, orig_len = record.unpack_from(buf, pos)
+        pos += record.size
+        yield link_type, byte_order, ts_sec + ts_frac * ts_scale, pos, pos + incl_len
+        pos += incl_len
+
+# returns the seconds per timestamp tick from an interface description
+# block's options
+def pcapng_ts_scale(buf, byte_order, pos, end):
+    ts_scale = 1e-6
+    while pos + 4 <= end:
+        code, length = struct.unpack_from(byte_order + 'HH', buf, pos)
+        if code == PCAPNG_OPT_END:
+            break
+        if code == PCAPNG_OPT_IF_TSRESOL and length >= 1:
+            resol = buf[pos + 4]
+            if resol & 0x80:
+                ts_scale = 2.0 ** -(resol & 0x7f)
+            else:
+                ts_scale = 10.0 ** -resol
+        pos += 4 + ((length + 3) & ~3)
+    return ts_scale
+
+# yields (link_type, byte_order, timestamp, start, end) for each packet of
+# a pcapng file. simple packet blocks carry no timestamp (None).
+def iter_pcapng_frames(buf):
+    byte_order = '<'
+    interfaces = []# (link_type, ts_scale)
+    pos = 0
+    while pos + 12 <= len(buf):
+        block_type = struct.unpack_from(byte_order + 'I', buf, pos)[0]
+        if block_type == PCAPNG_SECTION_HEADER:
+            # every section can have its own byte order and interfaces
+            if struct.unpack_from('<I', buf, pos + 8)[0] == PCAPNG_BYTE_ORDER_MAGIC:
+                byte_order = '<'
+            else:
+                byte_order = '>'
+            interfaces = []
+        block_len = struct.unpack_from(byte_order + 'I', buf, pos + 4)[0]
+        if block_len < 12:
+            raise RuntimeError("corrupt pcapng block at offset %d" % pos)
+        body = pos + 8
+        if block_type == PCAPNG_INTERFACE_DESCRIPTION:
+            link_type = struct.unpack_from(byte_order + 'H', buf, body)[0]
+            ts_scale = pcapng_ts_scale(buf, byte_order, body + 8, pos + block_len - 4)
+            interfaces.append((link_type, ts_scale))
+        elif block_type == PCAPNG_ENHANCED_PACKET:
+            if_id, ts_high, ts_low, cap_len, orig_len = struct.unpack_from(byte_order + 'IIIII', buf, body)
+            link_type, ts_scale = interfaces[if_id]
+            yield link_type, byte_order, ((ts_high << 32) | ts_low) * ts_scale, body + 20, body + 20 + cap_len
+        elif block_type == PCAPNG_PACKET:
+            if_id, drops, ts_high, ts_low, cap_len, orig_len = struct.unpack_from(byte_order + 'HHIIII', buf, body)
+            link_type, ts_scale = interfaces[if_id]
+            yield link_type, byte_order, ((ts_high << 32) | ts_low) * ts_scale, body + 20, body + 20 + cap_len
+        elif block_type == PCAPNG_SIMPLE_PACKET:
+            orig_len = struct.unpack_from(byte_order + 'I', buf, body)[0]
+            cap_len = min(orig_len, block_len - 16)
+            yield interfaces[0][0], byte_order, None, body + 4, body + 4 + cap_len
+        pos += block_len
+
+# Reads packets straight from a libpcap or pcapng capture of a Linux
+# (usbmon) or macOS USB bus. The USB pseudo header of each frame is decoded
+# to find the HID report, so Packet.cmd_offset points at the report for
+# either OS. Frames of other link types and frames without a report are
+# skipped. Packets reference the capture in place; nothing is copied.
+#
+# usbmon only captures the data of a control transfer in the direction it
+# travels: a SET_REPORT's data is in its submit and a GET_REPORT's in its
+# completion. SET_REPORT completions point at their submit's data here so
+# completions look the same as in macOS captures.
+def parse_pkts_from_pcap(pcap_file, **kwargs):
+    max_pkts = kwargs.get('max_pkts', None)
+
+    buf = map_file(pcap_file)
+    if struct.unpack_from('<I', buf, 0)[0] == PCAPNG_SECTION_HEADER:
+        frames = iter_pcapng_frames(buf)
+    else:
+        frames = iter_pcap_frames(buf)
+
+    pkts = PacketList(buf)
+    usbmon_headers = {}
+    submits = {}# usbmon urb id -> (report_type, start, end) of control transfers
+    for link_type, byte_order, timestamp, start, end in frames:
+        if link_type == LINKTYPE_USB_DARWIN:
+            if end - start < 4:
+                continue
+            cmd_offset = buf[start + 2]
+            if end - start < cmd_offset + 3 or cmd_offset < 31:
+                continue
+            pkts.append(start, end, cmd_offset, timestamp, buf[start + 3] & 0x01, buf[start + 30] & 0x80)
+        elif link_type == LINKTYPE_USB_LINUX or link_type == LINKTYPE_USB_LINUX_MMAPPED:
+            header = usbmon_headers.get(byte_order)
+            if header is None:
+                header = struct.Struct(USBMON_HEADER % byte_order)
+                usbmon_headers[byte_order] = header
+            if link_type == LINKTYPE_USB_LINUX:
+                header_len = USBMON_HEADER_LEN
+            else:
+                header_len = USBMON_MMAPPED_HEADER_LEN
+            if end - start < header_len:
+                continue
+            (urb_id, event, xfer_type, epnum, devnum, busnum, flag_setup, flag_data,
+                ts_sec, ts_usec, status, length, len_cap, setup) = header.unpack_from(buf, start)
+            end = min(end, start + header_len + len_cap)
+            report_type = epnum & 0x80
+            if event == USBMON_SUBMIT:
+                request_type = RequestType.SUBMIT.value
+                if xfer_type == USB_TRANSFER_CONTROL and flag_setup == 0:
+                    # control transfers go both ways on endpoint 0. the setup
+                    # packet's direction bit tells SET_REPORT from GET_REPORT
+                    report_type = setup[0] & 0x80
+                    submits[urb_id] = (report_type, start, end)
+            elif event == USBMON_COMPLETE:
+                request_type = RequestType.COMPLETE.value
+                submit = submits.pop(urb_id, None)
+                if submit is not None:
+                    report_type = submit[0]
+                    if report_type == ReportType.SET_REPORT.value:
+                        # point the completion at the submit's data
+                        start, end = submit[1], submit[2]
+            else:
+                # error events carry no data
+                continue
+            if end - start < header_len + 3:
+                continue
+            pkts.append(start, end, header_len, timestamp, request_type, report_type)
+        else:
+            continue
+
+        if max_pkts and len(pkts) >= max_pkts:
+            break
+    return pkts
+
+# reads packets from a libpcap/pcapng capture or a Wireshark text export,
+# whichever pcap_file turns out to be
+def read_pkts(pcap_file, **kwargs):
+    buf = map_file(pcap_file)
+    if is_pcap(buf):
+        return parse_pkts_from_pcap(buf, **kwargs)
+    return parse_pkts_fast(buf, **kwargs)
+
+INDEX_MAGIC = b'FBIDX'
+INDEX_VERSION = 2
+# bytes hashed from each end of a capture to tell if it changed
+INDEX_HASH_BYTES = 1024 * 1024
+
+# returns what an index needs to tell whether the capture changed since
+def capture_fingerprint(filename, buf):
+    st = os.stat(filename)
+    digest = hashlib.sha1()
+    digest.update(buf[:INDEX_HASH_BYTES])
+    digest.update(buf[max(0, len(buf) - INDEX_HASH_BYTES):])
+    return {
+        'size' : st.st_size,
+        'mtime_ns' : st.st_mtime_ns,
+        'hash' : digest.hexdigest()
+    }
+
+# Index of every packet in a capture: where it is in the file plus the
+# fields used for filtering, stored in arrays (one entry per packet).
+#
+# For pcap captures starts/ends are the packet's offsets in the file. For
+# text exports they are the span of text the packet was parsed from, so a
+# packet is loaded by parsing only its own lines.
+#
+# Saved next to the capture as '<capture>.idx': a magic line, a json header
+# line (format version, capture fingerprint, packet count) and the raw
+# arrays in COLUMNS order.
+class CaptureIndex(object):
+    COLUMNS = [
+        ('starts', 'q'),
+        ('ends', 'q'),
+        ('cmd_offsets', 'H'),
+        ('timestamps', 'd'),
+        ('request_types', 'h'),
+        ('report_types', 'h'),
+        ('opcodes', 'h'),# -1 -> not a completed SET_REPORT (or too short)
+        ('tags', 'h')]
+
+    # kind - 'pcap' or 'text'
+    def __init__(self, kind):
+        self.kind = kind
+        for name, typecode in self.COLUMNS:
+            setattr(self, name, array.array(typecode))
+
+    def __len__(self):
+        return len(self.starts)
+
+    # parses a whole capture. returns (index, pkts)
+    @classmethod
+    def build(cls, buf):
+        if is_pcap(buf):
+            pkts = parse_pkts_from_pcap(buf)
+            return cls.from_pkts(pkts), pkts
+        text_spans = array.array('q')
+        pkts = parse_pkts_fast(buf, text_spans=text_spans)
+        index = cls.from_pkts(pkts, 'text')
+        index.starts = text_spans[0::2]
+        index.ends = text_spans[1::2]
+        return index, pkts
+
+    # indexes packets that were already parsed. with kind 'pcap' packets are
+    # loaded by their offsets, which works for any PacketList's own buffer
+    @classmethod
+    def from_pkts(cls, pkts, kind='pcap'):
+        index = cls(kind)
+        index.starts = pkts.starts
+        index.ends = pkts.ends
+        index.cmd_offsets = pkts.cmd_offsets
+        index.timestamps = pkts.timestamps
+        index.request_types = pkts.request_types
+        index.report_types = pkts.report_types
+
+        # only completed SET_REPORTs carry an opcode. in responses and
+        # submits that byte is a status or payload byte
+        data = pkts.buf
+        complete = RequestType.COMPLETE.value
+        set_report = ReportType.SET_REPORT.value
+        columns = zip(pkts.starts, pkts.ends, pkts.cmd_offsets, pkts.request_types, pkts.report_types)
+        for start, end, cmd_offset, request_type, report_type in columns:
+            if start + cmd_offset + 3 < end:
+                index.tags.append(data[start + cmd_offset + 2])
+                if request_type == complete and report_type == set_report:
+                    index.opcodes.append(data[start + cmd_offset + 3])
+                else:
+                    index.opcodes.append(-1)
+            else:
+                index.tags.append(-1)
+                index.opcodes.append(-1)
+        return index
+
+    # returns the index saved in filename, or None if it is missing, from
+    # another format version or for a different capture (fingerprint)
+    @classmethod
+    def load(cls, filename, fingerprint):
+        try:
+            with open(filename, 'rb') as f:
+                if f.readline().rstrip(b'\n') != INDEX_MAGIC:
+                    return None
+                header = json.loads(f.readline())
+                if header.get('version') != INDEX_VERSION or header.get('fingerprint') != fingerprint:
+                    return None
+                index = cls(header['kind'])
+                n_pkts = header['n_pkts']
+                for name, typecode in cls.COLUMNS:
+                    column = getattr(index, name)
+                    column.fromfile(f, n_pkts)
+        except (OSError, ValueError, KeyError, EOFError):
+            return None
+        return index
+
+    def save(self, filename, fingerprint):
+        header = {
+            'version' : INDEX_VERSION,
+            'kind' : self.kind,
+            'fingerprint' : fingerprint,
+            'n_pkts' : len(self)
+        }
+        # write then rename so a crash never leaves a half written index
+        tmp_filename = filename + '.tmp'
+        with open(tmp_filename, 'wb') as f:
+            f.write(INDEX_MAGIC + b'\n')
+            f.write(json.dumps(header).encode('utf-8') + b'\n')
+            for name, typecode in self.COLUMNS:
+                getattr(self, name).tofile(f)
+        os.replace(tmp_filename, filename)
+
+    # returns the packet numbers in [first, last) that match the filters
+    # opcodes - optional collection of opcode values to keep. a matching
+    #     request is kept with its SET_REPORT submit and the GET_REPORT
+    #     packets up to its response (paired like iter_transactions() does)
+    def select(self, first=0, last=None, opcodes=None):
+        last = len(self) if last is None else min(last, len(self))
+        if opcodes is None:
+            return range(first, last)
+        opcodes = set(opcodes)
+        complete = RequestType.COMPLETE.value
+        set_report = ReportType.SET_REPORT.value
+        numbers = []
+        set_submit = None# SET_REPORT submit of the next request
+        response_tag = None# tag of the kept request still waiting for its response
+        for num in range(first, last):
+            if self.report_types[num] == set_report:
+                if self.request_types[num] != complete:
+                    set_submit = num
+                    continue
+                response_tag = None
+                if self.opcodes[num] in opcodes:
+                    if set_submit is not None:
+                        numbers.append(set_submit)
+                    numbers.append(num)
+                    response_tag = self.tags[num]
+                set_submit = None
+            elif response_tag is not None:
+                numbers.append(num)
+                if self.request_types[num] == complete and self.tags[num] == response_tag:
+                    response_tag = None
+        # a submit can come in before the last response it follows
+        numbers.sort()
+        return numbers
+
+    # loads the given packets (sorted packet numbers) from the capture
+    # returns a PacketList whose packets keep their original numbers
+    def load_pkts(self, buf, numbers):
+        if self.kind == 'pcap':
+            pkts = PacketList(buf)
+            pkts.ids = array.array('q', numbers)
+            for name, typecode in self.COLUMNS:
+                if hasattr(pkts, name):
+                    column = getattr(self, name)
+                    setattr(pkts, name, array.array(typecode, [column[num] for num in numbers]))
+            return pkts
+
+        # parse each run of consecutive packets in one go
+        shared = bytearray()
+        pkts = PacketList(shared)
+        pkts.ids = array.array('q')
+        run_first = 0
+        while run_first < len(numbers):
+            if isinstance(numbers, range):
+                run_last = len(numbers) - 1# select() without an opcode filter
+            else:
+                run_last = run_first
+                while run_last + 1 < len(numbers) and numbers[run_last + 1] == numbers[run_last] + 1:
+                    run_last += 1
+            first_num = numbers[run_first]
+            run = parse_pkts_fast(buf[self.starts[first_num]:self.ends[numbers[run_last]]])
+            if len(run) != run_last - run_first + 1:
+                raise RuntimeError("packet index doesn't match the capture; delete it to rebuild")
+            if run_first == 0 and run_last == len(numbers) - 1:
+                # a single run (ie. a --range) needs no merging
+                if first_num != 0:
+                    run.ids = array.array('q', range(first_num, first_num + len(run)))
+                return run
+            base = len(shared)
+            shared.extend(run.buf)
+            for i in range(len(run)):
+                pkts.append(base + run.starts[i], base + run.ends[i], run.cmd_offsets[i], run.timestamps[i],
+                    run.request_types[i], run.report_types[i])
+                pkts.ids.append(first_num + i)
+            run_first = run_last + 1
+        return pkts
+
+# Reads packets through the capture's index sidecar ('<capture>.idx'). The
+# index is built (and saved, if possible) when it is missing or stale, so
+# only the first run over a capture has to parse all of it.
+# first, last - range of packet numbers to load ([first, last))
+# max_pkts - stop reading after this many packets. like use_index=False this
+#     parses the capture directly, only up to the last packet wanted, and
+#     neither reads nor writes the sidecar
+# opcodes - optional collection of opcode values to keep
+# use_index - set False to neither read nor write the sidecar (the filters
+#     are applied to the parsed packets)
+def read_pkts_indexed(pcap_file, **kwargs):
+    first = kwargs.get('first', 0)
+    last = kwargs.get('last', None)
+    max_pkts = kwargs.get('max_pkts', None)
+    opcodes = kwargs.get('opcodes', None)
+    use_index = kwargs.get('use_index', True)
+    if max_pkts:
+        last = max_pkts if last is None else min(last, max_pkts)
+
+    if not use_index or max_pkts:
+        # bounded read. building the sidecar would mean parsing everything
+        pkts = read_pkts(pcap_file, max_pkts=last)
+        if first == 0 and opcodes is None:
+            return pkts
+        index = CaptureIndex.from_pkts(pkts)
+        return index.load_pkts(pkts.buf, index.select(first, last, opcodes))
+
+    buf = map_file(pcap_file)
+    filename = getattr(pcap_file, 'name', None)
+    index = None
+    fingerprint = None
+    if isinstance(filename, str) and os.path.isfile(filename):
+        fingerprint = capture_fingerprint(filename, buf)
+        index = CaptureIndex.load(filename + '.idx', fingerprint)
+    if index is None:
+        index, pkts = CaptureIndex.build(buf)
+        if fingerprint is not None:
+            try:
+                index.save(filename + '.idx', fingerprint)
+            except OSError:
+                pass# ie. read only directory. the next run just rebuilds it
+        if first == 0 and last is None and opcodes is None:
+            return pkts
+    return index.load_pkts(buf, index.select(first, last, opcodes))
+
+# seconds between attempts to reopen a band that rebooted during a replay
+REPLAY_POLL_INTERVAL = 0.1
+
+# waits for fuelband device to reconnect to PC and returns it
+def wait_for_device(timeout=10, poll_interval=1.0):
+    return nike.wait_for_fuelband(timeout, poll_interval)
+
+# yields the completed SET_REPORT packets (the Fuelband requests)
+def iter_set_reports(pkts):
+    if isinstance(pkts, PacketList):
+        yield from pkts.select(RequestType.COMPLETE, ReportType.SET_REPORT)
+        return
+    for pkt in pkts:
         if pkt.report_type != ReportType.SET_REPORT:
             continue
         if pkt.request_type != RequestType.COMPLETE:
             continue
+        yield pkt
 
+# extracts all Fuelband requests from pkts list
+def get_all_requests(pkts):
+    requests = deque()
+    for pkt in iter_set_reports(pkts):
         requests.append(Request(pkt))
     return requests
 
-# replays request packets to a real fuelband device
+# returns the SE_Opcode name for an opcode value ('0x??' if it isn't one)
+def opcode_name(value):
+    return enum_name(nike.SE_Opcode, value)
+
+# returns the name of enum_cls's member with value ('0x??' if there's none)
+def enum_name(enum_cls, value):
+    try:
+        return enum_cls(value).name
+    except ValueError:
+        return '0x%02x' % value
+
+# A request and the response the band answered it with
+# request - the completed SET_REPORT packet
+# response - the completed GET_REPORT carrying the answer (None if the
+#     capture doesn't have one)
+# submit - the SET_REPORT submit packet (None if it wasn't captured)
+class Transaction(object):
+    __slots__ = ('request', 'response', 'submit')
+
+    def __init__(self, request, response=None, submit=None):
+        self.request = request
+        self.response = response
+        self.submit = submit
+
+    # raw opcode byte of the request (None if the report is too short)
+    @property
+    def opcode(self):
+        pkt = self.request
+        offset = pkt.start + pkt.cmd_offset + 3
+        return pkt.buf[offset] if offset < pkt.end else None
+
+    # seconds from submitting the request to the response completing, None
+    # without a response or timestamps
+    @property
+    def latency(self):
+        if self.response is None or self.response.timestamp is None:
+            return None
+        sent = self.submit if self.submit is not None else self.request
+        if sent.timestamp is None:
+            return None
+        return self.response.timestamp - sent.timestamp
+
+# returns the tag of a packet's HID report (None if it's too short)
+def report_tag(pkt):
+    offset = pkt.start + pkt.cmd_offset + 2
+    return pkt.buf[offset] if offset < pkt.end else None
+
+# Pairs the requests in a capture with their responses. Every completed
+# SET_REPORT is a request; its response is the next completed GET_REPORT
+# echoing the request's tag. GET_REPORTs with any other tag (stale reads,
+# polls that came back empty) are skipped.
+# opcodes - optional collection of request opcode values to keep. requests
+#     are filtered after pairing, so pkts must not be filtered by opcode
+# returns an iterator over a Transaction per request, in capture order
+def iter_transactions(pkts, opcodes=None):
+    if opcodes is None:
+        return _pair_transactions(pkts)
+    opcodes = set(opcodes)
+    return (transaction for transaction in _pair_transactions(pkts) if transaction.opcode in opcodes)
+
+def _pair_transactions(pkts):
+    submit = None
+    current = None
+    for pkt in pkts:
+        report_type = pkt.report_type
+        if pkt.request_type == RequestType.SUBMIT:
+            if report_type == ReportType.SET_REPORT:
+                submit = pkt
+            continue
+        if report_type == ReportType.SET_REPORT:
+            if current is not None:
+                yield current
+            current = Transaction(pkt, submit=submit)
+            current_tag = report_tag(pkt)
+            submit = None
+        elif current is not None and report_tag(pkt) == current_tag:
+            current.response = pkt
+            yield current
+            current = None
+    if current is not None:
+        yield current
+
+# yields (request, response) for every completed SET_REPORT (see
+# iter_transactions()); response is None if the capture has no answer
+def iter_exchanges(pkts, opcodes=None):
+    for transaction in iter_transactions(pkts, opcodes):
+        yield transaction.request, transaction.response
+
+# Request to response latencies of every opcode in a capture
+# opcodes - optional collection of request opcode values to keep
+# returns a dict with
+#     'opcodes' - {opcode name: nike.metrics.LatencyHistogram}
+#     'transactions' - number of requests
+#     'unanswered' - requests without a response in the capture
+#     'untimed' - answered requests without timestamps (ie. text exports)
+def latency_stats(pkts, **kwargs):
+    keep_opcodes = kwargs.get('opcodes', None)
+
+    opcodes = {}
+    n_transactions = 0
+    n_unanswered = 0
+    n_untimed = 0
+    for transaction in iter_transactions(pkts, keep_opcodes):
+        n_transactions += 1
+        if transaction.response is None:
+            n_unanswered += 1
+            continue
+        latency = transaction.latency
+        if latency is None:
+            n_untimed += 1
+            continue
+        opcode = transaction.opcode
+        name = opcode_name(opcode) if opcode is not None else 'none'
+        if name not in opcodes:
+            opcodes[name] = nike.metrics.LatencyHistogram()
+        opcodes[name].add(latency)
+    return {
+        'opcodes' : opcodes,
+        'transactions' : n_transactions,
+        'unanswered' : n_unanswered,
+        'untimed' : n_untimed
+    }
+
+# returns a table of {opcode name: LatencyHistogram}, busiest opcode first
+def latency_table(opcodes):
+    lines = ['%-24s %8s %10s %10s %10s %10s %10s' % ('opcode','reqs','mean','min','p50','p99','max')]
+    for opcode, hist in sorted(opcodes.items(), key=lambda item: -item[1].count):
+        lines.append('%-24s %8d %8.2fms %8.2fms %8.2fms %8.2fms %8.2fms' % (
+            opcode,
+            hist.count,
+            hist.mean() * 1e3,
+            (hist.min or 0.0) * 1e3,
+            hist.percentile(50) * 1e3,
+            hist.percentile(99) * 1e3,
+            (hist.max or 0.0) * 1e3))
+    return lines
+
+# returns a printable summary of a latency_stats() result
+def latency_summary(stats):
+    lines = latency_table(stats['opcodes'])
+    lines.append('%d request(s); %d without a response; %d without timestamps' % (
+        stats['transactions'],
+        stats['unanswered'],
+        stats['untimed']))
+    return '\n'.join(lines)
+
+# extracts all Fuelband requests and their captured responses from pkts
+# opcodes - optional collection of request opcode values to keep (filtered
+#     after pairing, see iter_transactions())
+# returns (requests, responses); responses[i] is a Response or None
+def get_all_exchanges(pkts, opcodes=None):
+    requests = deque()
+    responses = deque()
+    for req_pkt, rsp_pkt in iter_exchanges(pkts, opcodes):
+        requests.append(Request(req_pkt))
+        responses.append(Response(rsp_pkt) if rsp_pkt is not None else None)
+    return requests, responses
+
+# Replays requests to a fuelband (real or emulated) and measures how long
+# each one takes.
+# mode - 'fast' sends every request as soon as the last one is answered.
+#     'timed' keeps the captured spacing between requests (needs a capture
+#     with timestamps, ie. pcap/pcapng)
+# responses - captured responses (see get_all_exchanges()). when given, every
+#     live response is compared against the captured one
+# reconnect - function returning a reopened band when a request fails with
+#     an OSError (ie. the request rebooted the band). defaults to polling for
+#     a real band every REPLAY_POLL_INTERVAL seconds
+# returns a dict with
+#     'requests' - number of requests sent
+#     'elapsed' - seconds from the first request to the last response
+#     'bytes_sent' - bytes of HID reports sent
+#     'requests_per_sec', 'bytes_per_sec' - throughput, reboots excluded
+#     'latencies' - [(pkt_id, opcode, seconds), ...] for answered requests
+#     'opcodes' - {opcode name: nike.metrics.LatencyHistogram}
+#     'bad_pkts' - request indexes the band rebooted/disconnected on
+#     'mismatches' - [(pkt_id, expected, actual), ...] responses that differ
+#     'verified' - number of responses compared
+#     'reconnect_time' - seconds spent waiting for the band to come back
+#     'fuelband' - the band in use at the end (differs from fb after a reboot)
 def replay(fb, requests, **kwargs):
     verbose = kwargs.get('verbose', False)
+    mode = kwargs.get('mode', 'fast')
+    responses = kwargs.get('responses', None)
+    reconnect = kwargs.get('reconnect', None)
+    if reconnect is None:
+        reconnect = lambda: wait_for_device(poll_interval=REPLAY_POLL_INTERVAL)
+    if mode not in ('fast', 'timed'):
+        raise ValueError("unknown replay mode '%s'" % mode)
+    if mode == 'timed' and any(req.timestamp is None for req in requests):
+        raise ValueError("timed replay needs a capture with timestamps (pcap or pcapng)")
 
+    latencies = []
+    opcodes = {}
     bad_pkts = []
+    mismatches = []
+    n_verified = 0
+    n_sent = 0
+    bytes_sent = 0
+    reconnect_time = 0.0
+    t_start = time.perf_counter()
+    t_first = requests[0].timestamp if mode == 'timed' and len(requests) > 0 else None
     try:
         for idx, req in enumerate(requests):
+            if t_first is not None:
+                # wall clock time this request went out in the capture.
+                # time spent reconnecting shifts the whole schedule
+                delay = t_start + reconnect_time + (req.timestamp - t_first) - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
             if verbose:
                 print("sending request #%d ..." % idx)
                 print(req.pretty_str())
             # some requests cause device to reboot. catch the error due
             # to reboot, wait for device to reconnect, and keep on going
+            n_sent += 1
+            bytes_sent += req.req_len + 2
+            t_req = time.perf_counter()
             try:
-                resp = req.send_to_device(fb)
-                if verbose:
-                    print("resp: %s" % resp)
+                # trimmed to the response length, for comparing to the capture
+                resp = req.send_to_device(fb, trim=True)
             except OSError:
                 if verbose:
                     print("device seems to have rebooted on pkt #%d" % idx)
                 bad_pkts.append(idx)
-                fb = wait_for_device()
+                t_lost = time.perf_counter()
+                fb = reconnect()
+                reconnect_time += time.perf_counter() - t_lost
+                continue
+            latency = time.perf_counter() - t_req
+            opcode = req.opcode.name
+            latencies.append((req.id, opcode, latency))
+            if opcode not in opcodes:
+                opcodes[opcode] = nike.metrics.LatencyHistogram()
+            opcodes[opcode].add(latency)
+            if verbose:
+                print("resp: %s (%.3fms)" % (resp, latency * 1e3))
+
+            expected = responses[idx] if responses is not None else None
+            if expected is not None:
+                actual = bytes(resp)
+                n_verified += 1
+                if actual != bytes(expected.payload):
+                    mismatches.append((req.id, bytes(expected.payload), actual))
     except KeyboardInterrupt:
         pass
+    elapsed = time.perf_counter() - t_start
+    busy = elapsed - reconnect_time
     if verbose:
         print("bad_pkts = %s" % bad_pkts)
-    return bad_pkts
+    return {
+        'requests' : n_sent,
+        'elapsed' : elapsed,
+        'bytes_sent' : bytes_sent,
+        'requests_per_sec' : n_sent / busy if busy > 0 else 0.0,
+        'bytes_per_sec' : bytes_sent / busy if busy > 0 else 0.0,
+        'latencies' : latencies,
+        'opcodes' : opcodes,
+        'bad_pkts' : bad_pkts,
+        'mismatches' : mismatches,
+        'verified' : n_verified,
+        'reconnect_time' : reconnect_time,
+        'fuelband' : fb
+    }
 
-def dissect_pkts(pkts, **kwargs):
-    gpack_file = kwargs.get('gpack_file', None)
+# opcode values compared against raw report bytes
+SETTING_GET_VALUE = nike.SE_Opcode.SETTING_GET.value
+SETTING_SET_VALUE = nike.SE_Opcode.SETTING_SET.value
+BATTERY_STATE_VALUE = nike.SE_Opcode.BATTERY_STATE.value
+# opcodes whose requests are memory transactions (see GenericMemoryBlock)
+MEMORY_OPCODES = frozenset([
+    nike.SE_Opcode.UPLOAD_GRAPHICS_PACK.value,
+    nike.SE_Opcode.DESKTOP_DATA.value,
+    nike.SE_Opcode.MEMORY_EXT.value,
+    nike.SE_Opcode.FIRMWARE.value])
+MEMORY_CHUNK_CMDS = frozenset([
+    nike.SE_MemCmds.READ_CHUNK.value,
+    nike.SE_MemCmds.WRITE_CHUNK.value])
+# firmware chunks carry 24bit addresses (see nike.firmware), the rest 16bit
+FIRMWARE_VALUE = nike.SE_Opcode.FIRMWARE.value
 
-    gpack_mem = MemDump(64 * 1024)
-    for pkt in pkts:
-        if pkt.report_type != ReportType.SET_REPORT:
+# decodes the address and length of a READ_CHUNK/WRITE_CHUNK request
+# payload - offset of the memory command in buf
+# returns (address, length), None if the request is cut short
+def decode_memory_chunk(buf, opcode, payload, payload_end):
+    addr_len = 3 if opcode == FIRMWARE_VALUE else 2
+    if payload + 2 + addr_len >= payload_end:
+        return None
+    address = 0
+    for i in range(addr_len):
+        address |= buf[payload + 1 + i] << (8 * i)
+    pos = payload + 1 + addr_len
+    return address, buf[pos] | (buf[pos + 1] << 8)
+
+# yields (pkt_id, buf, start, end, cmd_offset, timestamp) for every
+# completed SET_REPORT, straight from a PacketList's arrays when possible
+# (timestamp is nan when there is none)
+def iter_set_report_spans(pkts):
+    if isinstance(pkts, PacketList):
+        buf = pkts.buf
+        complete = RequestType.COMPLETE.value
+        set_report = ReportType.SET_REPORT.value
+        starts = pkts.starts
+        ends = pkts.ends
+        cmd_offsets = pkts.cmd_offsets
+        timestamps = pkts.timestamps
+        ids = pkts.ids
+        for idx, types in enumerate(zip(pkts.request_types, pkts.report_types)):
+            if types[0] == complete and types[1] == set_report:
+                pkt_id = idx if ids is None else ids[idx]
+                yield pkt_id, buf, starts[idx], ends[idx], cmd_offsets[idx], timestamps[idx]
+        return
+    for pkt in iter_set_reports(pkts):
+        timestamp = NO_TIMESTAMP if pkt.timestamp is None else pkt.timestamp
+        yield pkt.id, pkt.buf, pkt.start, pkt.end, pkt.cmd_offset, timestamp
+
+# Counts what the requests in a capture do, reading the fields straight from
+# the reports (no Request objects or strings).
+# interval - seconds per throughput bucket
+# returns a dict with
+#     'requests', 'bytes' - totals (bytes of HID reports)
+#     'opcodes' - {opcode: [requests, bytes]}
+#     'subcmds' - {(opcode, SE_SubCmdSett value): [requests, value bytes]}
+#     'memcmds' - {(opcode, SE_MemCmds value): [requests, data bytes]}
+#     'ranges' - {(opcode, SE_MemCmds value): [[start, end], ...]} merged
+#         address ranges read/written in chunks
+#     'throughput' - {bucket: [requests, bytes]}; bucket n covers
+#         [n * interval, (n + 1) * interval) seconds into the capture
+#     'first_timestamp', 'last_timestamp' - None without timestamps
+#     'interval'
+def summarize_pkts(pkts, **kwargs):
+    interval = kwargs.get('interval', 1.0)
+
+    n_requests = 0
+    n_bytes = 0
+    opcodes = {}
+    subcmds = {}
+    memcmds = {}
+    ranges = {}
+    throughput = {}
+    first_ts = None
+    last_ts = None
+    for pkt_id, buf, start, end, cmd_offset, timestamp in iter_set_report_spans(pkts):
+        offset = start + cmd_offset
+        if offset + 3 >= end:
             continue
-        if pkt.request_type != RequestType.COMPLETE:
+        req_len = buf[offset + 1]
+        opcode = buf[offset + 3]
+        report_len = req_len + 2
+        n_requests += 1
+        n_bytes += report_len
+
+        counts = opcodes.get(opcode)
+        if counts is None:
+            counts = opcodes[opcode] = [0, 0]
+        counts[0] += 1
+        counts[1] += report_len
+
+        if timestamp == timestamp:
+            if first_ts is None:
+                first_ts = timestamp
+            last_ts = timestamp
+            bucket = int((timestamp - first_ts) // interval)
+            counts = throughput.get(bucket)
+            if counts is None:
+                counts = throughput[bucket] = [0, 0]
+            counts[0] += 1
+            counts[1] += report_len
+
+        payload = offset + 4
+        payload_end = min(offset + 2 + req_len, end)
+        if opcode == SETTING_SET_VALUE and payload + 1 < payload_end:
+            key = (opcode, buf[payload])
+            n_data = buf[payload + 1]
+        elif opcode == SETTING_GET_VALUE and payload + 1 < payload_end:
+            key = (opcode, buf[payload + 1])
+            n_data = 0
+        elif opcode in MEMORY_OPCODES and payload < payload_end:
+            memcmd = buf[payload]
+            key = (opcode, memcmd)
+            n_data = 0
+            chunk = None
+            if memcmd in MEMORY_CHUNK_CMDS:
+                chunk = decode_memory_chunk(buf, opcode, payload, payload_end)
+            if chunk is not None:
+                address, n_data = chunk
+                key_ranges = ranges.get(key)
+                if key_ranges is None:
+                    key_ranges = ranges[key] = []
+                # chunks are usually sequential; grow the last range in place
+                if key_ranges and key_ranges[-1][1] == address:
+                    key_ranges[-1][1] = address + n_data
+                else:
+                    key_ranges.append([address, address + n_data])
+            counts = memcmds.get(key)
+            if counts is None:
+                counts = memcmds[key] = [0, 0]
+            counts[0] += 1
+            counts[1] += n_data
+            continue
+        else:
             continue
+        counts = subcmds.get(key)
+        if counts is None:
+            counts = subcmds[key] = [0, 0]
+        counts[0] += 1
+        counts[1] += n_data
+
+    return {
+        'requests' : n_requests,
+        'bytes' : n_bytes,
+        'opcodes' : opcodes,
+        'subcmds' : subcmds,
+        'memcmds' : memcmds,
+        'ranges' : dict((key, nike.dump.merge_ranges(key_ranges)) for key, key_ranges in ranges.items()),
+        'throughput' : throughput,
+        'first_timestamp' : first_ts,
+        'last_timestamp' : last_ts,
+        'interval' : interval
+    }
+
+# returns a printable report of a summarize_pkts() result
+def summary_str(summary):
+    lines = ['%-40s %10s %12s' % ('opcode','reqs','bytes')]
+    for opcode, counts in sorted(summary['opcodes'].items(), key=lambda item: -item[1][0]):
+        lines.append('%-40s %10d %12d' % (opcode_name(opcode), counts[0], counts[1]))
+
+    if summary['subcmds']:
+        lines.append('')
+        lines.append('%-40s %10s %12s' % ('setting','reqs','value bytes'))
+        for key, counts in sorted(summary['subcmds'].items(), key=lambda item: -item[1][0]):
+            name = '%s %s' % (opcode_name(key[0]), enum_name(nike.SE_SubCmdSett, key[1]))
+            lines.append('%-40s %10d %12d' % (name, counts[0], counts[1]))
+
+    if summary['memcmds']:
+        lines.append('')
+        lines.append('%-40s %10s %12s  %s' % ('memory command','reqs','data bytes','address ranges'))
+        for key, counts in sorted(summary['memcmds'].items(), key=lambda item: -item[1][0]):
+            name = '%s %s' % (opcode_name(key[0]), enum_name(nike.SE_MemCmds, key[1]))
+            key_ranges = summary['ranges'].get(key, [])
+            text = ', '.join('0x%04x-0x%04x' % (start, end) for start, end in key_ranges[:4])
+            if len(key_ranges) > 4:
+                text += ', ... (%d ranges)' % len(key_ranges)
+            lines.append('%-40s %10d %12d  %s' % (name, counts[0], counts[1], text))
+
+    lines.append('')
+    first_ts = summary['first_timestamp']
+    if first_ts is None:
+        lines.append('%d request(s), %d bytes; no timestamps' % (summary['requests'], summary['bytes']))
+        return '\n'.join(lines)
+
+    duration = summary['last_timestamp'] - first_ts
+    interval = summary['interval']
+    throughput = summary['throughput']
+    lines.append('%d request(s), %d bytes in %.3fs (%.1f req/s, %.1f KiB/s)' % (
+        summary['requests'],
+        summary['bytes'],
+        duration,
+        summary['requests'] / duration if duration > 0 else 0.0,
+        summary['bytes'] / duration / 1024 if duration > 0 else 0.0))
+    lines.append('%10s %10s %12s' % ('time','req/s','KiB/s'))
+    for bucket in range(max(throughput) + 1):
+        counts = throughput.get(bucket, [0, 0])
+        lines.append('%9.1fs %10.1f %12.1f' % (bucket * interval, counts[0] / interval, counts[1] / interval / 1024))
+    return '\n'.join(lines)
+
+# fields of an exported request: (name, numpy dtype, struct format)
+REQUEST_FIELDS = [
+    ('id', '<i8', 'q'),# packet number
+    ('opcode', '|u1', 'B'),
+    ('subcmd', '<i2', 'h'),# see decode_request_fields(). -1 -> none
+    ('tag', '|u1', 'B'),
+    ('address', '<i4', 'i'),# -1 -> not a memory chunk request
+    ('length', '<u2', 'H'),
+    ('payload_offset', '<i8', 'q'),# -1 -> not a pcap/pcapng capture
+    ('timestamp', '<f8', 'd')]# nan -> no timestamp
+REQUEST_RECORD = struct.Struct('<' + ''.join(field[2] for field in REQUEST_FIELDS))
 
-        req = upcast_request(Request(pkt))
-        print(req.pretty_str())
-        if isinstance(req, UploadGraphicsPack):
-            gpack_mem.add_block(req.address, req.mem)
+# Decodes the export fields of a request straight from its report
+# returns (opcode, subcmd, tag, address, length, payload_start, payload_end)
+# or None if the report is too short to have an opcode
+#     subcmd - SE_SubCmdSett for settings, SE_MemCmds for memory opcodes and
+#         SE_SubCmdBatt for BATTERY_STATE (-1 for anything else)
+#     address - address of READ_CHUNK/WRITE_CHUNK requests (-1 otherwise)
+#     length - bytes read/written by memory chunks, the value length of
+#         SETTING_SET, the payload length for everything else
+def decode_request_fields(buf, start, end, cmd_offset):
+    offset = start + cmd_offset
+    if offset + 3 >= end:
+        return None
+    tag = buf[offset + 2]
+    opcode = buf[offset + 3]
+    payload = offset + 4
+    # the length byte counts the tag and opcode too
+    payload_end = min(offset + 2 + buf[offset + 1], end)
+    subcmd = -1
+    address = -1
+    length = max(0, payload_end - payload)
+    if opcode == SETTING_SET_VALUE and payload + 1 < payload_end:
+        subcmd = buf[payload]
+        length = buf[payload + 1]
+    elif opcode == SETTING_GET_VALUE and payload + 1 < payload_end:
+        subcmd = buf[payload + 1]
+    elif opcode == BATTERY_STATE_VALUE and payload < payload_end:
+        subcmd = buf[payload]
+    elif opcode in MEMORY_OPCODES and payload < payload_end:
+        subcmd = buf[payload]
+        chunk = None
+        if subcmd in MEMORY_CHUNK_CMDS:
+            chunk = decode_memory_chunk(buf, opcode, payload, payload_end)
+        if chunk is not None:
+            address, length = chunk
+    return opcode, subcmd, tag, address, length, payload, payload_end
+
+# returns the name of a decode_request_fields() subcmd (None if there's none)
+def subcmd_name(opcode, subcmd):
+    if subcmd < 0:
+        return None
+    if opcode in (SETTING_SET_VALUE, SETTING_GET_VALUE):
+        return enum_name(nike.SE_SubCmdSett, subcmd)
+    if opcode == BATTERY_STATE_VALUE:
+        return enum_name(nike.SE_SubCmdBatt, subcmd)
+    return enum_name(nike.SE_MemCmds, subcmd)
+
+# yields (pkt_id, timestamp, buf, fields) for every request, fields as
+# returned by decode_request_fields() (offsets into buf)
+def iter_request_fields(pkts):
+    for pkt_id, buf, start, end, cmd_offset, timestamp in iter_set_report_spans(pkts):
+        fields = decode_request_fields(buf, start, end, cmd_offset)
+        if fields is not None:
+            yield pkt_id, timestamp, buf, fields
+
+# True when the payload offsets of pkts' requests are capture file offsets.
+# they are for pcap/pcapng captures, whose packets are read in place; text
+# exports are decoded into a separate buffer.
+def request_file_offsets(pkts):
+    return isinstance(pkts, PacketList) and is_pcap(pkts.buf)
+
+# Writes the requests in pkts as JSON Lines, one object per request:
+#   {"id": 12, "timestamp": 1.5, "opcode": "SETTING_SET", "subcmd": "WEIGHT",
+#    "tag": 255, "address": null, "length": 4, "payload_offset": 580,
+#    "payload": "4104..."}
+# names are used for opcode/subcmd; null marks a field that doesn't apply
+# (see REQUEST_FIELDS)
+# returns the number of requests written
+def export_jsonl(pkts, f):
+    file_offsets = request_file_offsets(pkts)
+    n_requests = 0
+    for pkt_id, timestamp, buf, fields in iter_request_fields(pkts):
+        opcode, subcmd, tag, address, length, payload, payload_end = fields
+        record = {
+            'id' : pkt_id,
+            'timestamp' : timestamp if timestamp == timestamp else None,
+            'opcode' : opcode_name(opcode),
+            'subcmd' : subcmd_name(opcode, subcmd),
+            'tag' : tag,
+            'address' : address if address >= 0 else None,
+            'length' : length,
+            'payload_offset' : payload if file_offsets else None,
+            'payload' : binascii.b2a_hex(buf[payload:payload_end]).decode('ascii')
+        }
+        f.write(json.dumps(record))
+        f.write('\n')
+        n_requests += 1
+    return n_requests
+
+# Writes the requests in pkts as a NumPy .npy file holding a 1-d structured
+# array with the REQUEST_FIELDS dtype. The file is written directly, so
+# exporting doesn't need numpy; see load_requests_npy() to read it back.
+# returns the number of requests written
+def export_npy(pkts, f):
+    file_offsets = request_file_offsets(pkts)
+    records = bytearray()
+    pack = REQUEST_RECORD.pack
+    n_requests = 0
+    for pkt_id, timestamp, buf, fields in iter_request_fields(pkts):
+        opcode, subcmd, tag, address, length, payload, payload_end = fields
+        records += pack(pkt_id, opcode, subcmd, tag, address, length,
+            payload if file_offsets else -1, timestamp)
+        n_requests += 1
+
+    # .npy version 1.0: magic, version, header length and a python literal
+    # header, padded with spaces so the data starts 64 byte aligned
+    descr = [(name, dtype) for name, dtype, fmt in REQUEST_FIELDS]
+    header = "{'descr': %r, 'fortran_order': False, 'shape': (%d,), }" % (descr, n_requests)
+    header += ' ' * (-(10 + len(header) + 1) % 64) + '\n'
+    f.write(b'\x93NUMPY\x01\x00')
+    f.write(struct.pack('<H', len(header)))
+    f.write(header.encode('latin1'))
+    f.write(records)
+    return n_requests
+
+# loads a file written by export_npy() as a numpy structured array
+# mmap_mode - passed on to numpy.load ('r' maps the file instead of reading it)
+def load_requests_npy(filename, mmap_mode=None):
+    try:
+        import numpy
+    except ImportError:
+        raise RuntimeError("loading .npy exports needs numpy (pip install numpy)")
+    return numpy.load(filename, mmap_mode=mmap_mode)
+
+# returns a printable summary of a replay() result
+def replay_summary(result):
+    lines = latency_table(result['opcodes'])
+    lines.append('%d request(s) in %.3fs: %.1f req/s, %.1f KiB/s sent; %d reboot(s) (%.3fs)' % (
+        result['requests'],
+        result['elapsed'],
+        result['requests_per_sec'],
+        result['bytes_per_sec'] / 1024,
+        len(result['bad_pkts']),
+        result['reconnect_time']))
+    if result['verified']:
+        lines.append('%d of %d response(s) differ from the capture' % (
+            len(result['mismatches']), result['verified']))
+    return '\n'.join(lines)
+
+# dissects a single request packet
+# returns (text, gpack_block) where gpack_block is (address, bytes) for
+# graphics pack writes and None otherwise
+def dissect_request(pkt):
+    req = upcast_request(Request(pkt))
+    gpack_block = None
+    if isinstance(req, UploadGraphicsPack):
+        gpack_block = (req.address, bytes(req.mem))
+    return req.pretty_str(), gpack_block
+
+# writes a rebuilt graphics pack to gpack_file, if there is one
+# gpack_sparse - leave the holes unwritten instead of zero filling them
+def write_gpack(gpack_mem, gpack_file, gpack_sparse=False):
+    if not gpack_file:
+        return
+    if gpack_sparse:
+        gpack_mem.write_sparse(gpack_file)
+    else:
+        gpack_mem.write_flat(gpack_file)
+
+# prints the requests in pkts and rebuilds the graphics pack they write
+# responses - also print the response (and latency) of every request
+# opcodes - with responses, only print requests with these opcode values
+#     (filtered after pairing, see iter_transactions())
+# returns the graphics pack MemDump
+def dissect_pkts(pkts, **kwargs):
+    gpack_file = kwargs.get('gpack_file', None)
+    gpack_sparse = kwargs.get('gpack_sparse', False)
+    responses = kwargs.get('responses', False)
+    opcodes = kwargs.get('opcodes', None)
+
+    if responses:
+        transactions = iter_transactions(pkts, opcodes)
+    else:
+        transactions = (Transaction(pkt) for pkt in iter_set_reports(pkts))
+
+    gpack_mem = MemDump(64 * 1024)
+    for transaction in transactions:
+        pkt = transaction.request
+        text, gpack_block = dissect_request(pkt)
+        print(text)
+        if transaction.response is not None:
+            print(Response(transaction.response).pretty_str(latency=transaction.latency))
+        if gpack_block:
+            gpack_mem.add_block(*gpack_block, pkt_id=pkt.id)
     
-    if gpack_file:
-        gpack_file.write(gpack_mem.mem)
+    write_gpack(gpack_mem, gpack_file, gpack_sparse)
+    return gpack_mem
+
+# returns [(pkt.id, text, gpack_block), ...] for the requests in pkts
+def dissect_all(pkts, first_id=0):
+    return [(first_id + pkt.id,) + dissect_request(pkt) for pkt in iter_set_reports(pkts)]
+
+# process pool worker: parses and dissects bytes [start, end) of a text export
+def dissect_text_chunk(job):
+    filename, start, end = job
+    with open(filename, 'rb') as f:
+        buf = map_file(f)
+    pkts = parse_pkts_fast(buf[start:end])
+    return len(pkts), dissect_all(pkts)
+
+# process pool worker: dissects a range of an already parsed pcap capture
+def dissect_pcap_chunk(job):
+    filename, first_id, columns = job
+    with open(filename, 'rb') as f:
+        buf = map_file(f)
+    pkts = PacketList.from_columns(buf, columns)
+    return len(pkts), dissect_all(pkts, first_id)
+
+# returns offsets that split a text export into about n_chunks pieces. every
+# piece starts on the line after a blank line, so no packet is cut in two.
+def text_split_points(buf, n_chunks):
+    points = [0]
+    size = len(buf)
+    for k in range(1, n_chunks):
+        blank = buf.find(b'\n\n', max(points[-1], size * k // n_chunks))
+        if blank < 0:
+            break
+        if blank + 2 > points[-1]:
+            points.append(blank + 2)
+    points.append(size)
+    return points
+
+# Same output as read_pkts() + dissect_pkts(), but the capture is split at
+# packet boundaries and the pieces are parsed and dissected in a process
+# pool. Results are merged in capture order, graphics pack writes included.
+# Text exports are split before parsing; pcap captures are parsed (offsets
+# only) up front and split by packet.
+# jobs - number of worker processes
+def dissect_parallel(pcap_file, jobs, **kwargs):
+    max_pkts = kwargs.get('max_pkts', None)
+    gpack_file = kwargs.get('gpack_file', None)
+    gpack_sparse = kwargs.get('gpack_sparse', False)
+    chunks_per_job = kwargs.get('chunks_per_job', 4)
+
+    filename = getattr(pcap_file, 'name', None)
+    if jobs <= 1 or not isinstance(filename, str) or not os.path.isfile(filename):
+        # workers reopen the capture by name, so pipes etc. stay sequential
+        return dissect_pkts(read_pkts(pcap_file, max_pkts=max_pkts),
+            gpack_file=gpack_file,
+            gpack_sparse=gpack_sparse)
+
+    n_chunks = jobs * chunks_per_job
+    buf = map_file(pcap_file)
+    if is_pcap(buf):
+        pkts = parse_pkts_from_pcap(buf, max_pkts=max_pkts)
+        chunk_len = max(1, -(-len(pkts) // n_chunks))
+        worker = dissect_pcap_chunk
+        work = [(filename, start, pkts.columns(start, start + chunk_len))
+            for start in range(0, len(pkts), chunk_len)]
+    else:
+        points = text_split_points(buf, n_chunks)
+        worker = dissect_text_chunk
+        work = [(filename, points[i], points[i + 1]) for i in range(len(points) - 1)]
+
+    gpack_mem = MemDump(64 * 1024)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        n_pkts = 0# packets in the chunks before this one
+        for chunk_pkts, results in pool.map(worker, work):
+            for pkt_id, text, gpack_block in results:
+                # ids of text chunks are relative to the chunk
+                if worker == dissect_text_chunk:
+                    pkt_id += n_pkts
+                if max_pkts and pkt_id >= max_pkts:
+                    break
+                print(text)
+                if gpack_block:
+                    gpack_mem.add_block(*gpack_block, pkt_id=pkt_id)
+            n_pkts += chunk_pkts
+            if max_pkts and n_pkts >= max_pkts:
+                break
+
+    write_gpack(gpack_mem, gpack_file, gpack_sparse)
+    return gpack_mem
+
+# argparse type for --range: 'A:B', 'A:' or ':B' -> (first, last)
+def pkt_range(text):
+    first, sep, last = text.partition(':')
+    if not sep:
+        raise argparse.ArgumentTypeError("expected FIRST:LAST, got '%s'" % text)
+    try:
+        return (int(first) if first else 0, int(last) if last else None)
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected FIRST:LAST, got '%s'" % text)
+
+# argparse type for --opcode: SE_Opcode name or number -> opcode value
+def opcode_value(text):
+    try:
+        return nike.SE_Opcode[text.upper()].value
+    except KeyError:
+        pass
+    try:
+        return int(text, 0)
+    except ValueError:
+        raise argparse.ArgumentTypeError("unknown opcode '%s'" % text)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         prog='pcap_dissect',
-        description="dissects fuelband pcap text files")
+        description="dissects fuelband USB captures (pcap, pcapng or Wireshark text exports)")
 
     parser.add_argument(
         'pcap',
         type=argparse.FileType('rb'),
-        help="the pcap text file to read")
+        help="the capture file to read")
 
     parser.add_argument(
         '-m','--max-pkts',
@@ -272,30 +1913,179 @@ if __name__ == "__main__":
         default=None,
         type=argparse.FileType('wb'),
         help="graphics pack output file")
+
+    parser.add_argument(
+        '--gpack-sparse',
+        default=False,
+        action='store_true',
+        help="write the graphics pack as a sparse file (unwritten ranges become holes)")
     
+    parser.add_argument(
+        '-j','--jobs',
+        default=1,
+        type=int,
+        help="number of processes to dissect with (ignored with --range/--opcode)")
+
+    parser.add_argument(
+        '--range',
+        default=None,
+        type=pkt_range,
+        help="only read packets FIRST:LAST (packet numbers, LAST excluded)")
+
+    parser.add_argument(
+        '--opcode',
+        default=None,
+        type=opcode_value,
+        action='append',
+        help="only read packets with this opcode (SE_Opcode name or number). can be repeated")
+
+    parser.add_argument(
+        '--no-index',
+        default=False,
+        action='store_true',
+        help="don't read or write the capture's packet index ('<capture>.idx')")
+
+    parser.add_argument(
+        '--responses',
+        default=False,
+        action='store_true',
+        help="print the response to every request too (implies --jobs 1)")
+
+    parser.add_argument(
+        '--latency',
+        default=False,
+        action='store_true',
+        help="print per opcode request to response latencies instead of the requests")
+
+    parser.add_argument(
+        '--summary',
+        default=False,
+        action='store_true',
+        help="print request counts, bytes, address ranges and throughput instead of the requests")
+
+    parser.add_argument(
+        '--summary-interval',
+        default=1.0,
+        type=float,
+        help="seconds per line of the --summary throughput table")
+
+    parser.add_argument(
+        '--export-jsonl',
+        default=None,
+        type=argparse.FileType('w'),
+        help="write the decoded requests to a JSON Lines file instead of printing them")
+
+    parser.add_argument(
+        '--export-npy',
+        default=None,
+        type=argparse.FileType('wb'),
+        help="write the decoded requests to a NumPy .npy file instead of printing them")
+
     parser.add_argument(
         '--replay',
         default=False,
         action='store_true',
         help="replay pcap file to a connected Fuelband device")
 
+    parser.add_argument(
+        '--replay-mode',
+        default='fast',
+        choices=['fast', 'timed'],
+        help="replay as fast as possible, or with the captured spacing between requests")
+
+    parser.add_argument(
+        '--verify',
+        default=False,
+        action='store_true',
+        help="compare every response of a replay against the captured one")
+
+    parser.add_argument(
+        '--emulator',
+        default=False,
+        action='store_true',
+        help="replay to an emulated Fuelband SE (see nike.emulator)")
+
+    parser.add_argument(
+        '--replay-csv',
+        default=None,
+        type=argparse.FileType('w'),
+        help="write the latency of every replayed request to a csv file")
+
     args = parser.parse_args()
 
-    pkts = parse_pkts_from_file(
-        args.pcap,
-        max_pkts=args.max_pkts)
-    
+    first, last = args.range if args.range else (0, None)
+    filtered = args.range is not None or args.opcode is not None
+
+    # paired - the caller pairs requests with responses and filters by
+    #     opcode afterwards, so only the packet range is applied here
+    def read_selected_pkts(paired=False):
+        return read_pkts_indexed(
+            args.pcap,
+            max_pkts=args.max_pkts,
+            first=first,
+            last=last,
+            opcodes=None if paired else args.opcode,
+            use_index=not args.no_index)
+
     if args.replay:
-        fb = nike.open_fuelband()
+        pkts = read_selected_pkts(paired=True)
+
+        reconnect = None
+        if args.emulator:
+            fb = nike.emulator.open_emulated_fuelband()
+            def reconnect():
+                fb.device.open()
+                return fb
+        else:
+            fb = nike.open_fuelband()
         if fb == None:
             print("No fuelband devices found")
             exit(-1)
         
-        requests = get_all_requests(pkts)
+        requests, responses = get_all_exchanges(pkts, args.opcode)
         print("replaying %d request(s) ..." % len(requests))
-        bad_pkts = replay(fb, requests)
-        print("done! %d bad packet(s)" % len(bad_pkts))
+        result = replay(
+            fb,
+            requests,
+            mode=args.replay_mode,
+            responses=responses if args.verify else None,
+            reconnect=reconnect)
+        print(replay_summary(result))
+        if args.emulator:
+            print("note: replayed to an emulated band; these timings are not hardware numbers")
+        for pkt_id, expected, actual in result['mismatches'][:10]:
+            print("pkt #%d: expected %s; got %s" % (pkt_id, utils.to_hex(expected), utils.to_hex(actual)))
+        if args.replay_csv:
+            args.replay_csv.write("pkt_id,opcode,latency_ms\n")
+            for pkt_id, opcode, latency in result['latencies']:
+                args.replay_csv.write("%d,%s,%.3f\n" % (pkt_id, opcode, latency * 1e3))
+        if result['mismatches']:
+            exit(1)
+    elif args.export_jsonl or args.export_npy:
+        pkts = read_selected_pkts()
+        if args.export_jsonl:
+            n_requests = export_jsonl(pkts, args.export_jsonl)
+        if args.export_npy:
+            n_requests = export_npy(pkts, args.export_npy)
+        print("exported %d request(s)" % n_requests)
+    elif args.summary:
+        pkts = read_selected_pkts()
+        print(summary_str(summarize_pkts(pkts, interval=args.summary_interval)))
+    elif args.latency:
+        pkts = read_selected_pkts(paired=True)
+        print(latency_summary(latency_stats(pkts, opcodes=args.opcode)))
+    elif args.jobs > 1 and not filtered and not args.responses:
+        dissect_parallel(
+            args.pcap,
+            args.jobs,
+            max_pkts=args.max_pkts,
+            gpack_file=args.gpack_file,
+            gpack_sparse=args.gpack_sparse)
     else:
+        pkts = read_selected_pkts(paired=args.responses)
         dissect_pkts(
             pkts,
-            gpack_file=args.gpack_file)
\ No newline at end of file
+            gpack_file=args.gpack_file,
+            gpack_sparse=args.gpack_sparse,
+            responses=args.responses,
+            opcodes=args.opcode)